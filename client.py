@@ -1,10 +1,18 @@
 import socket
 import pickle
 import torch
-from torch.utils.data import DataLoader, Subset
-from torchvision import datasets, transforms
+from torch.utils.data import DataLoader, TensorDataset
 import os
-from model_def import MNISTNet
+import time
+from model_def import MNISTNet, GLOBAL_MODEL
+from client_state import ClientState, state_dict_hash, state_dict_distance
+import shm_transport
+import profiling
+from secure_agg import SecureAggClient, SECAGG_SETUP
+from privacy import RDPAccountant, make_per_sample_grad_fn, dp_sgd_step, poisson_batches
+from federated_eval import FED_EVAL, evaluate_counts
+from event_server import BUSY
+from personalization import split_state_dict
 
 SERVER_IP = "10.159.215.173"   # Replace with actual server IP
 PORT = 5000
@@ -12,7 +20,19 @@ PORT = 5000
 # Get client ID from environment or default to 0
 CLIENT_ID = int(os.environ.get("CLIENT_ID", "0"))
 NUM_CLIENTS = int(os.environ.get("NUM_CLIENTS", "2"))
+# Shard, optimizer momentum and last global model are kept here between rounds
+CLIENT_STATE_DIR = os.environ.get("CLIENT_STATE_DIR", f"client_state/client{CLIENT_ID}")
+# Local slice kept out of training for federated evaluation; set it (e.g. 0.1) when the server uses FED_EVAL_EVERY
+HOLDOUT_FRACTION = float(os.environ.get("HOLDOUT_FRACTION", "0"))
 
+# Differential privacy (DP-SGD) settings
+DP_SGD = os.environ.get("DP_SGD", "0") == "1"
+DP_NOISE_MULTIPLIER = float(os.environ.get("DP_NOISE_MULTIPLIER", "1.0"))
+DP_MAX_GRAD_NORM = float(os.environ.get("DP_MAX_GRAD_NORM", "1.0"))
+DP_DELTA = float(os.environ.get("DP_DELTA", "1e-5"))
+DP_ACCOUNTANT_FILE = os.path.join(CLIENT_STATE_DIR, "dp_accountant.json")  # Privacy budget spent across rounds
+
+@profiling.profiled
 def receive_data(sock):
     """Receive data with length prefix (matching server protocol)"""
     try:
@@ -40,27 +60,25 @@ def receive_data(sock):
     except Exception as e:
         raise RuntimeError(f"Error receiving data: {e}")
 
+@profiling.profiled
 def send_data(sock, data):
     """Send data with length prefix (matching server protocol)"""
     try:
-        data_bytes = pickle.dumps(data)
+        with profiling.section('serialize'):
+            data_bytes = pickle.dumps(data)
         length_bytes = len(data_bytes).to_bytes(4, 'big')
-        sock.sendall(length_bytes + data_bytes)
+        with profiling.section('network_send'):
+            sock.sendall(length_bytes + data_bytes)
         print(f"Sent {len(data_bytes)} bytes with 4-byte length prefix")
     except Exception as e:
         raise RuntimeError(f"Error sending data: {e}")
 
-def load_mnist_client_data(client_id, num_clients=2):
-    """Load MNIST data for this specific client"""
-    print(f"Loading MNIST data for client {client_id}/{num_clients-1}...")
-    
-    transform = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize((0.1307,), (0.3081,))
-    ])
+def build_mnist_shard(client_id, num_clients):
+    """Normalize this client's slice of the MNIST training set into tensors"""
+    from torchvision import datasets  # Only needed when the shard is not cached yet
     
     # Download MNIST if needed
-    dataset = datasets.MNIST('./data', train=True, download=True, transform=transform)
+    dataset = datasets.MNIST('./data', train=True, download=True)
     
     # Divide data among clients (simple split - each gets equal portion)
     total_samples = len(dataset)
@@ -68,21 +86,52 @@ def load_mnist_client_data(client_id, num_clients=2):
     start_idx = client_id * samples_per_client
     end_idx = start_idx + samples_per_client if client_id < num_clients - 1 else total_samples
     
-    # Create subset for this client
-    indices = list(range(start_idx, end_idx))
-    client_dataset = Subset(dataset, indices)
+    # Same result as ToTensor() + Normalize((0.1307,), (0.3081,)), applied to the whole slice at once
+    images = ((dataset.data[start_idx:end_idx].float() / 255.0 - 0.1307) / 0.3081).unsqueeze(1)
+    targets = dataset.targets[start_idx:end_idx].clone()
+    return images, targets
+
+def load_client_shard(client_id, num_clients=2, state=None):
+    """Load this client's shard split into (train, held-out) parts"""
+    print(f"Loading MNIST data for client {client_id}/{num_clients-1}...")
+    start = time.perf_counter()
     
-    print(f"Client {client_id} has {len(client_dataset)} samples (indices {start_idx}-{end_idx-1})")
+    if state is not None:
+        images, targets, cached = state.load_shard(build_mnist_shard)
+    else:
+        (images, targets), cached = build_mnist_shard(client_id, num_clients), False
     
-    return DataLoader(client_dataset, batch_size=32, shuffle=True)
+    # The tail of the shard is never trained on and is used for federated evaluation
+    split = len(targets) - int(len(targets) * HOLDOUT_FRACTION)
+    source = "cached shard" if cached else "built from MNIST"
+    print(f"Client {client_id} has {split} training + {len(targets) - split} held-out samples "
+          f"({source}, {time.perf_counter() - start:.2f}s)")
+    return (images[:split], targets[:split]), (images[split:], targets[split:])
 
-def local_train(model, client_id, epochs=5):
+def load_mnist_client_data(client_id, num_clients=2, state=None):
+    """Load MNIST data for this specific client"""
+    (images, targets), _ = load_client_shard(client_id, num_clients, state)
+    return DataLoader(TensorDataset(images, targets), batch_size=32, shuffle=True)
+
+@profiling.profiled
+def local_train(model, client_id, epochs=5, state=None):
     """Train model on local MNIST data"""
     print(f"Starting local training for client {client_id}...")
-    dataloader = load_mnist_client_data(client_id, NUM_CLIENTS)
+    with profiling.section('load_data'):
+        dataloader = load_mnist_client_data(client_id, NUM_CLIENTS, state)
     
     loss_fn = torch.nn.CrossEntropyLoss()
     optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+    if state is not None and state.restore_optimizer(optimizer):
+        print("Restored optimizer momentum from previous round")
+    
+    if DP_SGD:
+        per_sample_grad_fn = make_per_sample_grad_fn(model, loss_fn)
+        accountant = RDPAccountant.load(DP_ACCOUNTANT_FILE)
+        sample_rate = dataloader.batch_size / len(dataloader.dataset)
+        images, targets = dataloader.dataset.tensors
+        print(f"DP-SGD enabled: noise multiplier {DP_NOISE_MULTIPLIER}, max grad norm {DP_MAX_GRAD_NORM}, "
+              f"Poisson sampling rate {sample_rate:.4f}")
     
     model.train()
     for epoch in range(epochs):
@@ -90,12 +139,26 @@ def local_train(model, client_id, epochs=5):
         correct = 0
         total = 0
         
-        for batch_idx, (data, target) in enumerate(dataloader):
-            optimizer.zero_grad()
-            output = model(data)
-            loss = loss_fn(output, target)
-            loss.backward()
-            optimizer.step()
+        # DP-SGD samples each batch independently (as the accountant assumes), same number of steps
+        batches = poisson_batches(images, targets, sample_rate, len(dataloader)) if DP_SGD else dataloader
+        for batch_idx, (data, target) in enumerate(profiling.timed_iter(batches, 'data_loading')):
+            if DP_SGD:
+                # Per-sample clipping + Gaussian noise instead of the plain batch gradient
+                with profiling.section('dp_sgd_step'):
+                    output = dp_sgd_step(model, optimizer, per_sample_grad_fn, data, target,
+                                         DP_MAX_GRAD_NORM, DP_NOISE_MULTIPLIER, dataloader.batch_size)
+                if len(target) == 0:
+                    continue
+                loss = loss_fn(output, target)
+            else:
+                optimizer.zero_grad()
+                with profiling.section('forward'):
+                    output = model(data)
+                    loss = loss_fn(output, target)
+                with profiling.section('backward'):
+                    loss.backward()
+                with profiling.section('optimizer_step'):
+                    optimizer.step()
             
             epoch_loss += loss.item()
             pred = output.argmax(dim=1, keepdim=True)
@@ -106,13 +169,104 @@ def local_train(model, client_id, epochs=5):
         avg_loss = epoch_loss / len(dataloader)
         print(f"  Epoch {epoch+1}/{epochs}, Loss: {avg_loss:.4f}, Accuracy: {accuracy:.2f}%")
     
+    if DP_SGD:
+        accountant.step(DP_NOISE_MULTIPLIER, sample_rate, epochs * len(dataloader))
+        accountant.save(DP_ACCOUNTANT_FILE)
+        epsilon, order = accountant.get_epsilon(DP_DELTA)
+        print(f"Privacy budget spent so far: ε = {epsilon:.2f} (δ = {DP_DELTA}, RDP order {order})")
+    
+    if state is not None:
+        state.save_optimizer(optimizer)
     print("Local training complete")
     return model.state_dict()
 
+def build_model(global_state, state):
+    """
+    MNISTNet with the received weights
+    
+    In personalized mode the server only sends the shared layers; the missing ones are
+    this client's personal layers, restored from its state directory.
+    
+    Returns:
+        tuple: (model, set of personal parameter names)
+    """
+    model = MNISTNet()
+    personal_keys = set(model.state_dict()) - set(global_state)
+    if personal_keys:
+        personal_state = state.load_personal_layers()
+        if personal_state is not None and set(personal_state) == personal_keys:
+            model.load_state_dict(personal_state, strict=False)
+            print(f"Personalized mode: restored local {sorted(personal_keys)}")
+        else:
+            print(f"Personalized mode: initialized local {sorted(personal_keys)}")
+    model.load_state_dict(global_state, strict=not personal_keys)
+    return model, personal_keys
+
+def shared_update(updated_state, personal_keys, state):
+    """Save the personal layers locally and return the part of the update sent to the server"""
+    if not personal_keys:
+        return updated_state
+    shared, personal = split_state_dict(updated_state, personal_keys)
+    state.save_personal_layers(personal)
+    return shared
+
+def run_secure_aggregation(sock, setup, state):
+    """Take part in a secure aggregation round (the server only receives a masked update)"""
+    secagg = SecureAggClient(setup['index'], setup['round'])
+    print(f"Secure aggregation round {setup['round']}, client index {setup['index']}")
+    
+    # Advertise our public key, then share our secret with the neighbours
+    send_data(sock, {'public_key': secagg.public_key})
+    keys_msg = pickle.loads(receive_data(sock))
+    send_data(sock, {'shares': secagg.share_secret(keys_msg['public_keys'], keys_msg['threshold'])})
+    print(f"Key setup complete with {len(keys_msg['public_keys'])} neighbours")
+    
+    train_msg = pickle.loads(receive_data(sock))
+    secagg.receive_shares(train_msg['shares'])
+    model, personal_keys = build_model(train_msg['model'], state)
+    if train_msg.get('task') == FED_EVAL:
+        # Personalized evaluation: the personal layers are masked so the server only learns their average
+        counts = held_out_counts(model, state)
+        print("Sending masked personal layers to server...")
+        personal = split_state_dict(model.state_dict(), personal_keys)[1]
+        reply = {'masked': secagg.mask(personal, train_msg['neighbors']), 'counts': counts}
+    else:
+        updated_state = shared_update(local_train(model, CLIENT_ID, state=state), personal_keys, state)
+        print("Sending masked update to server...")
+        reply = {'masked': secagg.mask(updated_state, train_msg['neighbors'])}
+    send_data(sock, reply)
+    
+    # Help the server remove the self-masks of survivors and the masks of neighbours that dropped out
+    unmask_msg = pickle.loads(receive_data(sock))
+    send_data(sock, {'shares': secagg.reveal(unmask_msg['dropped'], unmask_msg['delivered'])})
+    print("Masked update sent successfully")
+    if train_msg.get('task') != FED_EVAL:
+        state.save_global(train_msg['model'], state_dict_hash(train_msg['model']), setup['round'])
+
+def held_out_counts(model, state):
+    """Score a model on the held-out slice; only these aggregate counts are sent to the server"""
+    _, (images, targets) = load_client_shard(CLIENT_ID, NUM_CLIENTS, state)
+    if len(targets) == 0:
+        print("WARNING: No held-out samples; set HOLDOUT_FRACTION (e.g. 0.1) to take part in federated evaluation")
+    counts = evaluate_counts(model, images, targets)
+    counts['client_id'] = CLIENT_ID
+    print(f"Held-out accuracy: {100. * counts['correct'] / max(counts['total'], 1):.2f}% "
+          f"({counts['correct']}/{counts['total']})")
+    return counts
+
+def run_federated_evaluation(sock, request, state):
+    """Score the global model on the held-out slice and send back only aggregate counts"""
+    print(f"Federated evaluation of round {request['round']} global model")
+    model, _ = build_model(request['model'], state)
+    send_data(sock, held_out_counts(model, state))
+    print("Counts sent to server")
+
 def main():
     client = None
     try:
         print(f"=== Federated Learning Client {CLIENT_ID} ===")
+        profiling.start_round(f"client{CLIENT_ID}_{time.strftime('%Y%m%d-%H%M%S')}")
+        state = ClientState(CLIENT_STATE_DIR, CLIENT_ID, NUM_CLIENTS)
         print(f"Connecting to server at {SERVER_IP}:{PORT}...")
         client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         client.settimeout(120)  # 2 minute timeout
@@ -123,20 +277,68 @@ def main():
         print("Waiting to receive global model...")
         recv_data = receive_data(client)
         global_state = pickle.loads(recv_data)
+        
+        if isinstance(global_state, dict) and global_state.get('type') == SECAGG_SETUP:
+            run_secure_aggregation(client, global_state, state)
+            return
+        if isinstance(global_state, dict) and global_state.get('type') == FED_EVAL:
+            run_federated_evaluation(client, global_state, state)
+            return
+        if isinstance(global_state, dict) and global_state.get('type') == BUSY:
+            print("Server is not admitting more clients this round. Try again later.")
+            return
+        
+        shm_offer = None
+        if isinstance(global_state, dict) and global_state.get('type') == shm_transport.SHM_OFFER:
+            # Server is on this host and offers the model through shared memory
+            shm_offer = global_state
+            try:
+                global_state = shm_transport.load_global_model(shm_offer)
+                print(f"Global model (version {shm_offer['version']}) read from shared memory")
+            except Exception as e:
+                print(f"Could not attach to shared memory ({e}), requesting model over socket")
+                shm_offer = None
+                send_data(client, {'type': shm_transport.SHM_NACK})
+                global_state = pickle.loads(receive_data(client))
+        version = shm_offer['version'] if shm_offer else None
+        if isinstance(global_state, dict) and global_state.get('type') == GLOBAL_MODEL:
+            version = global_state['round']
+            global_state = global_state['model']
         print("Global model received and deserialized")
         
-        model = MNISTNet()
-        model.load_state_dict(global_state)
-        print("Model loaded successfully")
+        model_hash = state_dict_hash(global_state)
+        previous = state.load_global()
+        if model_hash == state.last_global_hash:
+            print("Global model unchanged since last round")
+        elif previous is not None and previous.keys() == global_state.keys():
+            print(f"Global model moved {state_dict_distance(previous, global_state):.4f} (L2) "
+                  f"since round {state.last_global_version}")
+        
+        # An update trained on this exact global model survives a crash before sending
+        updated_state = state.load_pending_update(model_hash)
+        if updated_state is not None:
+            print("Resuming: reusing update already trained on this global model")
+        else:
+            model, personal_keys = build_model(global_state, state)
+            print("Model loaded successfully")
 
-        # Perform local training
-        updated_state = local_train(model, CLIENT_ID)
+            # Perform local training
+            updated_state = shared_update(local_train(model, CLIENT_ID, state=state), personal_keys, state)
+            state.save_pending_update(model_hash, updated_state)
 
         # Send updated weights
-        print("Sending updated model back to server...")
-        send_data(client, updated_state)
+        if shm_offer is not None:
+            print("Writing updated model to shared memory slot...")
+            shm_transport.write_update(shm_offer, updated_state)
+            send_data(client, {'type': shm_transport.SHM_UPDATE})
+        else:
+            print("Sending updated model back to server...")
+            send_data(client, updated_state)
         print("Updated model sent successfully")
         
+        state.save_global(global_state, model_hash, version)
+        state.clear_pending_update()
+        
     except socket.timeout:
         print("ERROR: Connection timed out")
     except ConnectionRefusedError:
@@ -150,6 +352,7 @@ def main():
         if client:
             client.close()
             print("Connection closed")
+        profiling.end_round()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,142 @@
+"""
+Local client state persisted between rounds
+Each client keeps a directory with its preprocessed data shard, the optimizer's
+momentum buffers, the last global model it received (with its hash and round), its personal
+layers in personalized mode and, while a round is in flight, the trained update
+that has not been delivered yet.
+"""
+import hashlib
+import json
+import os
+import torch
+from model_def import flatten_state_dict
+
+SHARD_FILE = 'shard.pt'
+OPTIMIZER_FILE = 'optimizer.pt'
+GLOBAL_MODEL_FILE = 'global_model.pt'
+PENDING_UPDATE_FILE = 'pending_update.pt'
+PERSONAL_LAYERS_FILE = 'personal_layers.pt'
+META_FILE = 'meta.json'
+
+
+def state_dict_hash(state_dict):
+    """SHA-256 of a state_dict's parameter values"""
+    flat, _ = flatten_state_dict(state_dict)
+    return hashlib.sha256(flat.numpy().tobytes()).hexdigest()
+
+
+def state_dict_distance(a, b):
+    """L2 norm of the difference between two state_dicts with the same layout"""
+    flat_a, _ = flatten_state_dict(a)
+    flat_b, _ = flatten_state_dict(b)
+    return (flat_a - flat_b).norm().item()
+
+
+def _atomic_save(obj, path):
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class ClientState:
+    """Directory-backed state of one client"""
+
+    def __init__(self, state_dir, client_id, num_clients):
+        self.state_dir = state_dir
+        self.client_id = client_id
+        self.num_clients = num_clients
+        os.makedirs(state_dir, exist_ok=True)
+        self.meta = {}
+        meta_path = self.path(META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                self.meta = json.load(f)
+
+    def path(self, name):
+        return os.path.join(self.state_dir, name)
+
+    def _save_meta(self):
+        tmp_path = self.path(META_FILE) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(tmp_path, self.path(META_FILE))
+
+    def load_shard(self, build_shard):
+        """
+        Return this client's preprocessed shard, building and caching it on first use
+
+        Args:
+            build_shard: Function (client_id, num_clients) -> (images, targets)
+
+        Returns:
+            tuple: (images, targets, cached)
+        """
+        shard_key = {'client_id': self.client_id, 'num_clients': self.num_clients}
+        if self.meta.get('shard') == shard_key and os.path.exists(self.path(SHARD_FILE)):
+            images, targets = torch.load(self.path(SHARD_FILE))
+            return images, targets, True
+
+        images, targets = build_shard(self.client_id, self.num_clients)
+        _atomic_save((images, targets), self.path(SHARD_FILE))
+        self.meta['shard'] = shard_key
+        self._save_meta()
+        return images, targets, False
+
+    def restore_optimizer(self, optimizer):
+        """Load saved momentum buffers into a freshly created optimizer (keeps its hyperparameters)"""
+        if not os.path.exists(self.path(OPTIMIZER_FILE)):
+            return False
+        current = optimizer.state_dict()
+        current['state'] = torch.load(self.path(OPTIMIZER_FILE))
+        optimizer.load_state_dict(current)
+        return True
+
+    def save_optimizer(self, optimizer):
+        _atomic_save(optimizer.state_dict()['state'], self.path(OPTIMIZER_FILE))
+
+    @property
+    def last_global_hash(self):
+        return self.meta.get('global_hash')
+
+    @property
+    def last_global_version(self):
+        return self.meta.get('global_version')
+
+    def save_global(self, state_dict, model_hash, version=None):
+        """Remember the global model this client last trained on (version = server round)"""
+        _atomic_save(state_dict, self.path(GLOBAL_MODEL_FILE))
+        self.meta['global_hash'] = model_hash
+        self.meta['global_version'] = version
+        self._save_meta()
+
+    def load_global(self):
+        """Last global model received (base for computing how far the next one moved)"""
+        if not os.path.exists(self.path(GLOBAL_MODEL_FILE)):
+            return None
+        return torch.load(self.path(GLOBAL_MODEL_FILE))
+
+    def save_personal_layers(self, state_dict):
+        """Keep the layers that stay on this client in personalized mode"""
+        _atomic_save(state_dict, self.path(PERSONAL_LAYERS_FILE))
+
+    def load_personal_layers(self):
+        if not os.path.exists(self.path(PERSONAL_LAYERS_FILE)):
+            return None
+        return torch.load(self.path(PERSONAL_LAYERS_FILE))
+
+    def save_pending_update(self, base_hash, state_dict):
+        """Keep a trained update until the server has received it"""
+        _atomic_save({'base_hash': base_hash, 'state_dict': state_dict}, self.path(PENDING_UPDATE_FILE))
+
+    def load_pending_update(self, base_hash):
+        """Update trained on the given global model that was never delivered, if any"""
+        if not os.path.exists(self.path(PENDING_UPDATE_FILE)):
+            return None
+        pending = torch.load(self.path(PENDING_UPDATE_FILE))
+        if pending['base_hash'] != base_hash:
+            return None
+        return pending['state_dict']
+
+    def clear_pending_update(self):
+        if os.path.exists(self.path(PENDING_UPDATE_FILE)):
+            os.remove(self.path(PENDING_UPDATE_FILE))
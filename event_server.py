@@ -0,0 +1,239 @@
+"""
+Event-driven networking core for the federated learning server
+A single selectors (epoll on Linux) loop multiplexes every client connection of a round.
+The global model is serialized once and every connection sends from the same buffer.
+Uploads are read into per-connection buffers bounded by MAX_MESSAGE_BYTES. A client
+gets an upload slot when the first bytes of its update arrive, not while it trains; at
+most MAX_CONCURRENT_UPLOADS connections are read from at a time (the rest are left to
+TCP flow control), and connections beyond the round's participants or MAX_CONNECTIONS
+are turned away with a small 'busy' message.
+"""
+import os
+import pickle
+import selectors
+import time
+from collections import deque
+
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", "10000"))
+MAX_CONCURRENT_UPLOADS = int(os.environ.get("MAX_CONCURRENT_UPLOADS", "64"))
+MAX_MESSAGE_BYTES = int(os.environ.get("MAX_MESSAGE_BYTES", str(64 * 1024 * 1024)))
+RECV_CHUNK = 256 * 1024
+BUSY = 'busy'   # server -> client: round is full, try again later
+
+# Connection states: WAITING_UPLOAD while the client trains, QUEUED once its update has
+# started arriving but every upload slot is taken
+SENDING, WAITING_UPLOAD, QUEUED, UPLOADING = range(4)
+
+
+def frame(data):
+    """Serialize an object with the 4-byte length prefix used by send_data"""
+    data_bytes = pickle.dumps(data)
+    return len(data_bytes).to_bytes(4, 'big') + data_bytes
+
+
+class Connection:
+    """Per-connection state: a view into the shared outgoing frame and the upload buffer"""
+    __slots__ = ('sock', 'fd', 'addr', 'admitted', 'state', 'out', 'header', 'header_read', 'payload',
+                 'payload_read', 'last_activity')
+
+    def __init__(self, sock, addr, out, admitted=True):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.addr = addr
+        self.admitted = admitted
+        self.state = SENDING
+        self.out = out
+        self.header = bytearray(4)
+        self.header_read = 0
+        self.payload = None
+        self.payload_read = 0
+        self.last_activity = time.monotonic()
+
+
+class EventServer:
+    """Runs federated rounds over a listening socket with one selector loop"""
+
+    def __init__(self, listener, max_connections=MAX_CONNECTIONS, max_uploads=MAX_CONCURRENT_UPLOADS,
+                 max_message_bytes=MAX_MESSAGE_BYTES, idle_timeout=120):
+        self.listener = listener
+        self.max_connections = max_connections
+        self.max_uploads = max_uploads
+        self.max_message_bytes = max_message_bytes
+        self.idle_timeout = idle_timeout
+        self.busy_frame = memoryview(frame({'type': BUSY}))
+        self.stats = {}
+
+    def run_round(self, message, num_participants, round_timeout=None, on_reply=None, log=print):
+        """
+        Send `message` to up to num_participants clients and collect one reply from each
+
+        Args:
+            message: Object sent to every participant (serialized once)
+            num_participants: Replies needed to finish the round
+            round_timeout: Seconds before the round ends with whatever arrived (None = wait)
+            on_reply: Optional function (addr, reply) called as each reply arrives instead of
+                      keeping it in the returned list
+
+        Returns:
+            list: (addr, reply object) for every completed participant; self.stats holds
+                  the round's connection counters
+        """
+        self.stats = {'accepted': 0, 'rejected': 0, 'peak_connections': 0, 'bytes_in': 0, 'bytes_out': 0}
+        out = memoryview(frame(message))
+        selector = selectors.DefaultSelector()
+        self.listener.setblocking(False)
+        selector.register(self.listener, selectors.EVENT_READ)
+
+        connections = {}
+        upload_queue = deque()
+        uploading = 0
+        admitted = 0
+        replies = []
+        completed = 0
+        failed = 0   # Admitted clients that dropped out; like the sequential server, they use up their slot
+        deadline = time.monotonic() + round_timeout if round_timeout else None
+
+        def close(conn, done=False):
+            nonlocal uploading, failed
+            if connections.pop(conn.fd, None) is None:
+                return
+            if conn.state == UPLOADING:
+                uploading -= 1
+            if conn.admitted and not done:
+                failed += 1
+            try:
+                selector.unregister(conn.sock)
+            except (KeyError, ValueError):
+                pass
+            conn.sock.close()
+
+        def start_upload(conn):
+            nonlocal uploading
+            conn.state = UPLOADING
+            uploading += 1
+            conn.last_activity = time.monotonic()
+
+        def start_uploads():
+            while upload_queue and uploading < self.max_uploads:
+                conn = upload_queue.popleft()
+                if conn.state != QUEUED:
+                    continue
+                start_upload(conn)
+                selector.register(conn.sock, selectors.EVENT_READ, conn)
+
+        try:
+            while completed + failed < num_participants:
+                now = time.monotonic()
+                if deadline and now >= deadline:
+                    log(f"Round timeout reached with {completed}/{num_participants} replies")
+                    break
+                timeout = 1.0 if deadline is None else max(0.0, min(1.0, deadline - now))
+                for key, events in selector.select(timeout):
+                    if key.fileobj is self.listener:
+                        admitted += self._accept(selector, connections, out, num_participants - admitted)
+                        continue
+                    conn = key.data
+                    try:
+                        if events & selectors.EVENT_WRITE and conn.state == SENDING:
+                            if self._write(conn):
+                                if not conn.admitted:
+                                    close(conn, done=True)
+                                    continue
+                                # Model delivered: the client trains, then its update makes the socket readable
+                                conn.state = WAITING_UPLOAD
+                                selector.modify(conn.sock, selectors.EVENT_READ, conn)
+                            continue
+                        if events & selectors.EVENT_READ and conn.state == WAITING_UPLOAD:
+                            if uploading >= self.max_uploads:
+                                # Update is arriving but all slots are taken: leave it to TCP flow control
+                                selector.unregister(conn.sock)
+                                conn.state = QUEUED
+                                upload_queue.append(conn)
+                                continue
+                            start_upload(conn)
+                        if events & selectors.EVENT_READ and conn.state == UPLOADING:
+                            reply = self._read(conn)
+                            if reply is not None:
+                                close(conn, done=True)
+                                completed += 1
+                                if on_reply:
+                                    on_reply(conn.addr, pickle.loads(reply))
+                                else:
+                                    replies.append((conn.addr, pickle.loads(reply)))
+                    except Exception as e:
+                        log(f"ERROR: Connection {conn.addr} failed: {e}")
+                        close(conn)
+                start_uploads()
+
+                # Drop connections that stopped making progress (clients still training are not timed out)
+                now = time.monotonic()
+                for conn in list(connections.values()):
+                    if conn.state in (SENDING, UPLOADING) and now - conn.last_activity > self.idle_timeout:
+                        log(f"ERROR: Client {conn.addr} timed out")
+                        close(conn)
+        finally:
+            for conn in list(connections.values()):
+                close(conn, done=True)
+            selector.unregister(self.listener)
+            selector.close()
+            self.listener.setblocking(True)
+        return replies
+
+    def _accept(self, selector, connections, out, open_slots):
+        """Accept every pending connection; admit up to open_slots of them"""
+        admitted = 0
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return admitted
+            sock.setblocking(False)
+            self.stats['accepted'] += 1
+            if admitted >= open_slots or len(connections) >= self.max_connections:
+                # Admission control: tell the client to come back later
+                self.stats['rejected'] += 1
+                conn = Connection(sock, addr, self.busy_frame, admitted=False)
+            else:
+                admitted += 1
+                conn = Connection(sock, addr, out)
+            connections[conn.fd] = conn
+            self.stats['peak_connections'] = max(self.stats['peak_connections'], len(connections))
+            selector.register(sock, selectors.EVENT_WRITE, conn)
+
+    def _write(self, conn):
+        """Send as much of the outgoing frame as the socket takes; True when done"""
+        try:
+            sent = conn.sock.send(conn.out)
+        except BlockingIOError:
+            return False
+        self.stats['bytes_out'] += sent
+        conn.out = conn.out[sent:]
+        conn.last_activity = time.monotonic()
+        return len(conn.out) == 0
+
+    def _read(self, conn):
+        """Read the next part of a length-prefixed upload; returns the payload when complete"""
+        if conn.header_read < 4:
+            n = conn.sock.recv_into(memoryview(conn.header)[conn.header_read:])
+            if n == 0:
+                raise ConnectionError("Connection closed while receiving length")
+            conn.header_read += n
+            conn.last_activity = time.monotonic()
+            if conn.header_read < 4:
+                return None
+            length = int.from_bytes(conn.header, 'big')
+            if length > self.max_message_bytes:
+                raise ValueError(f"Message of {length} bytes exceeds limit of {self.max_message_bytes}")
+            conn.payload = bytearray(length)
+            return conn.payload if length == 0 else None
+
+        view = memoryview(conn.payload)[conn.payload_read:]
+        n = conn.sock.recv_into(view, min(len(view), RECV_CHUNK))
+        if n == 0:
+            raise ConnectionError("Connection closed while receiving data")
+        conn.payload_read += n
+        self.stats['bytes_in'] += n
+        conn.last_activity = time.monotonic()
+        if conn.payload_read == len(conn.payload):
+            return conn.payload
+        return None
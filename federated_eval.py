@@ -0,0 +1,74 @@
+"""
+Federated evaluation
+Clients score the global model on their own held-out slice and report only aggregate
+counts (correct, total, loss sum and confusion rows). The server sums the counts into
+fleet-wide and per-class metrics; no samples or predictions leave the clients.
+"""
+import torch
+
+FED_EVAL = 'fed_eval'   # server -> client: global model to score on the held-out slice
+NUM_CLASSES = 10
+
+
+def evaluate_counts(model, images, targets, batch_size=1000):
+    """
+    Score a model on local data and return only aggregate counts
+
+    Returns:
+        dict: {'correct', 'total', 'loss_sum', 'confusion'} where confusion[t][p] counts
+              samples of true class t predicted as p
+    """
+    loss_fn = torch.nn.CrossEntropyLoss(reduction='sum')
+    model.eval()
+    correct = 0
+    loss_sum = 0.0
+    confusion = torch.zeros(NUM_CLASSES * NUM_CLASSES, dtype=torch.long)
+    with torch.inference_mode():
+        for start in range(0, len(targets), batch_size):
+            output = model(images[start:start + batch_size])
+            target = targets[start:start + batch_size]
+            pred = output.argmax(dim=1)
+            loss_sum += loss_fn(output, target).item()
+            correct += (pred == target).sum().item()
+            confusion += torch.bincount(target * NUM_CLASSES + pred, minlength=NUM_CLASSES * NUM_CLASSES)
+    return {
+        'correct': correct,
+        'total': len(targets),
+        'loss_sum': loss_sum,
+        'confusion': confusion.reshape(NUM_CLASSES, NUM_CLASSES).tolist(),
+    }
+
+
+def combine_counts(reports):
+    """
+    Combine client reports into fleet-wide and per-class metrics
+
+    Args:
+        reports: {client ID: counts from evaluate_counts}
+
+    Returns:
+        dict: fleet accuracy/loss, per-class accuracy (None for classes nobody holds),
+              per-client accuracy and the worst client
+    """
+    correct = sum(r['correct'] for r in reports.values())
+    total = sum(r['total'] for r in reports.values())
+    if total == 0:
+        raise ValueError("No evaluation samples reported")
+    confusion = torch.zeros(NUM_CLASSES, NUM_CLASSES, dtype=torch.long)
+    for r in reports.values():
+        confusion += torch.tensor(r['confusion'], dtype=torch.long)
+
+    class_totals = confusion.sum(dim=1)
+    per_class = [100. * confusion[c, c].item() / class_totals[c].item() if class_totals[c] else None
+                 for c in range(NUM_CLASSES)]
+    client_accuracies = {c: 100. * r['correct'] / r['total'] for c, r in reports.items() if r['total']}
+    worst = min(client_accuracies, key=client_accuracies.get)
+    return {
+        'accuracy': 100. * correct / total,
+        'loss': sum(r['loss_sum'] for r in reports.values()) / total,
+        'samples': total,
+        'per_class_accuracy': per_class,
+        'client_accuracies': client_accuracies,
+        'worst_client': worst,
+        'worst_client_accuracy': client_accuracies[worst],
+    }
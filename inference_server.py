@@ -0,0 +1,289 @@
+"""
+Batched inference server for the trained global model
+Loads MNISTNet once and answers prediction requests over the same length-prefixed
+pickle protocol as the training server. Requests from all connections are collected
+for up to MAX_WAIT_MS or MAX_BATCH images and run as one forward pass. The model is
+reloaded whenever the server writes a new round checkpoint.
+
+Usage:
+    python inference_server.py                      # serve global_model.pth
+    python inference_server.py --load-test 2000     # measure latency/throughput against a running server
+"""
+import argparse
+import os
+import pickle
+import queue
+import socket
+import threading
+import time
+from collections import deque
+import torch
+from model_export import build_variant
+from server import send_data, receive_data
+
+HOST = os.environ.get("INFERENCE_HOST", "0.0.0.0")
+PORT = int(os.environ.get("INFERENCE_PORT", "5001"))
+MODEL_PATH = os.environ.get("MODEL_PATH", "global_model.pth")
+MAX_BATCH = int(os.environ.get("MAX_BATCH", "256"))          # Images per forward pass
+MAX_WAIT_MS = float(os.environ.get("MAX_WAIT_MS", "5"))      # How long to wait for a batch to fill
+MODEL_VARIANT = os.environ.get("MODEL_VARIANT", "float")     # float, int8, torchscript or compiled
+RELOAD_CHECK_SECONDS = 1.0
+STATS_INTERVAL_SECONDS = 10.0
+
+
+class LatencyStats:
+    """Rolling latency percentiles and throughput"""
+
+    def __init__(self, window=10000):
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.images = 0
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def record(self, latency, num_images):
+        with self.lock:
+            self.latencies.append(latency)
+            self.requests += 1
+            self.images += num_images
+
+    def summary(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            elapsed = time.perf_counter() - self.started
+            requests, images = self.requests, self.images
+        if not latencies:
+            return {'requests': 0, 'p50_ms': 0.0, 'p99_ms': 0.0, 'images_per_sec': 0.0}
+        return {
+            'requests': requests,
+            'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+            'images_per_sec': images / elapsed,
+        }
+
+
+class PendingRequest:
+    """Images waiting for a batch slot, completed by the batching thread"""
+
+    def __init__(self, images):
+        self.images = images
+        self.received = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def load_model(path):
+    """Load the global model checkpoint for inference"""
+    return build_variant(torch.load(path, map_location='cpu'), MODEL_VARIANT)
+
+
+class MicroBatcher:
+    """Groups concurrent requests into single forward passes and hot-reloads the model"""
+
+    def __init__(self, model_path, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS):
+        self.model_path = model_path
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.stats = LatencyStats()
+        self.model = load_model(model_path)
+        self.model_mtime = os.path.getmtime(model_path)
+        self.last_reload_check = time.monotonic()
+        self.running = True
+
+    def submit(self, images):
+        """Queue images for prediction and block until the batch containing them has run"""
+        request = PendingRequest(images)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error:
+            raise request.error
+        self.stats.record(time.perf_counter() - request.received, images.shape[0])
+        return request.result
+
+    def maybe_reload(self):
+        """Swap in the latest checkpoint if the training server wrote a new one"""
+        now = time.monotonic()
+        if now - self.last_reload_check < RELOAD_CHECK_SECONDS:
+            return
+        self.last_reload_check = now
+        try:
+            mtime = os.path.getmtime(self.model_path)
+            if mtime != self.model_mtime:
+                self.model = load_model(self.model_path)
+                self.model_mtime = mtime
+                print(f"✓ Reloaded model from '{self.model_path}'")
+        except Exception as e:
+            print(f"WARNING: Could not reload model: {e}")
+
+    def collect_batch(self):
+        """Wait for the first request, then keep adding requests until the batch is full or the wait expires"""
+        try:
+            first = self.requests.get(timeout=RELOAD_CHECK_SECONDS)
+        except queue.Empty:
+            return []
+        batch = [first]
+        num_images = first.images.shape[0]
+        deadline = time.perf_counter() + self.max_wait
+        while num_images < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            num_images += request.images.shape[0]
+        return batch
+
+    def run(self):
+        while self.running:
+            self.maybe_reload()
+            batch = self.collect_batch()
+            if not batch:
+                continue
+            try:
+                images = torch.cat([r.images for r in batch])
+                with torch.inference_mode():
+                    probs = torch.softmax(self.model(images), dim=1)
+                offset = 0
+                for r in batch:
+                    n = r.images.shape[0]
+                    r.result = probs[offset:offset + n]
+                    offset += n
+            except Exception as e:
+                for r in batch:
+                    r.error = e
+            for r in batch:
+                r.done.set()
+
+
+def handle_connection(conn, addr, batcher):
+    """Serve prediction requests from one client until it disconnects"""
+    try:
+        while True:
+            try:
+                request = pickle.loads(receive_data(conn))
+            except RuntimeError:
+                break  # Client closed the connection
+            if request.get('type') == 'stats':
+                send_data(conn, batcher.stats.summary())
+                continue
+            images = torch.as_tensor(request['images'], dtype=torch.float32).reshape(-1, 1, 28, 28)
+            probs = batcher.submit(images)
+            send_data(conn, {
+                'predictions': probs.argmax(dim=1).tolist(),
+                'confidence': probs.max(dim=1).values.tolist(),
+            })
+    except Exception as e:
+        print(f"ERROR: Connection {addr} failed: {e}")
+    finally:
+        conn.close()
+
+
+def report_stats(batcher):
+    while batcher.running:
+        time.sleep(STATS_INTERVAL_SECONDS)
+        s = batcher.stats.summary()
+        if s['requests']:
+            print(f"[Stats] requests: {s['requests']}, p50: {s['p50_ms']:.2f} ms, "
+                  f"p99: {s['p99_ms']:.2f} ms, throughput: {s['images_per_sec']:.0f} images/s")
+
+
+def serve():
+    if not os.path.exists(MODEL_PATH):
+        print(f"Error: {MODEL_PATH} not found!")
+        print("Run the training server first to produce a global model.")
+        return
+
+    batcher = MicroBatcher(MODEL_PATH)
+    threading.Thread(target=batcher.run, daemon=True).start()
+    threading.Thread(target=report_stats, args=(batcher,), daemon=True).start()
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        server.bind((HOST, PORT))
+        server.listen(128)
+        print(f"{'='*60}")
+        print("MNIST Inference Server")
+        print(f"{'='*60}")
+        print(f"Serving '{MODEL_PATH}' ({MODEL_VARIANT} variant) on {HOST}:{PORT}")
+        print(f"Micro-batching: up to {MAX_BATCH} images or {MAX_WAIT_MS} ms per forward pass")
+        print(f"{'='*60}\n")
+        while True:
+            conn, addr = server.accept()
+            threading.Thread(target=handle_connection, args=(conn, addr, batcher), daemon=True).start()
+    except KeyboardInterrupt:
+        print("\nInference server interrupted by user")
+    finally:
+        batcher.running = False
+        s = batcher.stats.summary()
+        print(f"Served {s['requests']} requests, p50: {s['p50_ms']:.2f} ms, "
+              f"p99: {s['p99_ms']:.2f} ms, throughput: {s['images_per_sec']:.0f} images/s")
+        server.close()
+
+
+def run_load_test(host, port, num_requests, concurrency, images_per_request):
+    """Send requests from several connections and report end-to-end latency and throughput"""
+    latencies = []
+    lock = threading.Lock()
+    concurrency = max(1, min(concurrency, num_requests))
+    # Spread the remainder so exactly num_requests are sent
+    per_worker = [num_requests // concurrency + (1 if w < num_requests % concurrency else 0)
+                  for w in range(concurrency)]
+
+    def worker(count):
+        sock = socket.create_connection((host, port))
+        images = torch.randn(images_per_request, 1, 28, 28)
+        try:
+            for _ in range(count):
+                start = time.perf_counter()
+                send_data(sock, {'images': images})
+                pickle.loads(receive_data(sock))
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+        finally:
+            sock.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(count,)) for count in per_worker]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    if not latencies:
+        print("No requests completed")
+        return
+    latencies.sort()
+    print(f"{'='*50}")
+    print("Inference Load Test")
+    print(f"{'='*50}")
+    print(f"Requests: {len(latencies)} ({concurrency} connections, {images_per_request} images each)")
+    print(f"p50 latency: {latencies[len(latencies) // 2] * 1000:.2f} ms")
+    print(f"p99 latency: {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:.2f} ms")
+    print(f"Throughput: {len(latencies) / elapsed:.0f} requests/s, "
+          f"{len(latencies) * images_per_request / elapsed:.0f} images/s")
+    print(f"{'='*50}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched MNIST inference server")
+    parser.add_argument('--load-test', type=int, metavar='N', help="Send N requests to a running server")
+    parser.add_argument('--host', default='127.0.0.1', help="Server address for --load-test")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--images', type=int, default=1, help="Images per request for --load-test")
+    args = parser.parse_args()
+
+    if args.load_test:
+        run_load_test(args.host, PORT, args.load_test, args.concurrency, args.images)
+    else:
+        serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Load test for the event-driven server core
+Runs an EventServer round in a separate process on loopback and drives it with
+thousands of lightweight fake clients multiplexed by one selector in this process.
+Every fake client connects and receives the model payload; replies are only sent once
+all clients hold an open connection, so the server carries the full connection count
+at its peak. Reports connections per second, round time and server memory per connection.
+
+Usage:
+    python load_test_server.py --clients 1000 5000 --payload-kb 256 --reply-kb 256
+"""
+import argparse
+import multiprocessing
+import pickle
+import resource
+import selectors
+import socket
+import time
+from event_server import EventServer, frame
+
+MAX_PENDING_CONNECTS = 512   # Connects in flight at once, keeps the listen backlog from overflowing
+
+
+def raise_fd_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = hard if hard != resource.RLIM_INFINITY else max(soft, needed)
+    if soft < target:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    return target
+
+
+def current_rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def serve_round(port_queue, result_queue, num_clients, payload_bytes, max_uploads):
+    """Server process: one EventServer round, then report its stats and memory"""
+    raise_fd_limit(num_clients * 2 + 64)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(4096)
+    server = EventServer(listener, max_uploads=max_uploads)
+    message = bytes(payload_bytes)
+    base_rss = current_rss_kb()
+    peak_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    port_queue.put(listener.getsockname()[1])
+
+    replies = 0
+
+    def count_reply(addr, reply):
+        nonlocal replies
+        replies += 1   # Drop the update so memory reflects connection state only
+
+    start = time.perf_counter()
+    server.run_round(message, num_clients, on_reply=count_reply, log=lambda msg: None)
+    elapsed = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    listener.close()
+    result_queue.put({
+        'replies': replies,
+        'elapsed': elapsed,
+        'base_rss_kb': base_rss,
+        'peak_rss_kb': max(peak_rss, peak_before),
+        'rss_growth_kb': max(0, peak_rss - max(base_rss, peak_before)),
+        **server.stats,
+    })
+
+
+class FakeClient:
+    __slots__ = ('sock', 'received', 'expected', 'header', 'out')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.received = 0
+        self.expected = None
+        self.header = b''
+        self.out = None
+
+
+def run_fake_clients(port, num_clients, reply_bytes):
+    """
+    Connect num_clients sockets, read the model frame on each, then send every reply
+
+    Returns:
+        dict: {'connect_time', 'total_time', 'busy'}
+    """
+    selector = selectors.DefaultSelector()
+    reply = memoryview(frame(bytes(reply_bytes)))
+    busy_length = len(pickle.dumps({'type': 'busy'}))
+    clients = []
+    in_flight = 0
+    started = 0
+    holding = 0
+    busy = 0
+    start = time.perf_counter()
+
+    def open_more():
+        nonlocal in_flight, started
+        while started < num_clients and in_flight < MAX_PENDING_CONNECTS:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            sock.connect_ex(('127.0.0.1', port))
+            client = FakeClient(sock)
+            clients.append(client)
+            selector.register(sock, selectors.EVENT_READ, client)
+            in_flight += 1
+            started += 1
+
+    # Phase 1: connect everyone and read the model frame
+    open_more()
+    while holding + busy < num_clients:
+        events = selector.select(timeout=30)
+        if not events:
+            raise TimeoutError(f"Server stalled with {holding + busy}/{num_clients} clients served")
+        for key, _ in events:
+            client = key.data
+            try:
+                chunk = client.sock.recv(256 * 1024)
+            except (BlockingIOError, InterruptedError):
+                continue
+            if not chunk:
+                raise ConnectionError("Server closed a connection before sending the model")
+            if client.expected is None:
+                need = 4 - len(client.header)
+                client.header += chunk[:need]
+                chunk = chunk[need:]
+                if len(client.header) < 4:
+                    continue
+                client.expected = int.from_bytes(client.header, 'big')
+            client.received += len(chunk)
+            if client.received >= client.expected:
+                selector.unregister(client.sock)
+                in_flight -= 1
+                if client.expected == busy_length:  # Payloads are KBs, the busy message is a few bytes
+                    busy += 1
+                    client.sock.close()
+                else:
+                    holding += 1
+                    client.out = reply
+        open_more()
+    connect_time = time.perf_counter() - start
+
+    # Phase 2: all connections are open, send the replies
+    for client in clients:
+        if client.out is not None:
+            selector.register(client.sock, selectors.EVENT_WRITE, client)
+    pending = holding
+    while pending:
+        events = selector.select(timeout=30)
+        if not events:
+            raise TimeoutError(f"Server stopped reading with {pending} replies unsent")
+        for key, _ in events:
+            client = key.data
+            try:
+                sent = client.sock.send(client.out)
+            except BlockingIOError:
+                continue
+            client.out = client.out[sent:]
+            if not client.out:
+                selector.unregister(client.sock)
+                pending -= 1
+    total_time = time.perf_counter() - start
+    for client in clients:
+        client.sock.close()
+    selector.close()
+    return {'connect_time': connect_time, 'total_time': total_time, 'busy': busy}
+
+
+def run_load_test(num_clients, payload_bytes, reply_bytes, max_uploads, extra_clients=0):
+    raise_fd_limit(num_clients + extra_clients + 64)
+    port_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_round,
+                                     args=(port_queue, result_queue, num_clients, payload_bytes, max_uploads))
+    server.start()
+    port = port_queue.get(timeout=30)
+    client_stats = run_fake_clients(port, num_clients + extra_clients, reply_bytes)
+    server_stats = result_queue.get(timeout=300)
+    server.join()
+    return {**server_stats, **client_stats}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Event-driven server load test on loopback")
+    parser.add_argument('--clients', type=int, nargs='+', default=[1000, 5000])
+    parser.add_argument('--payload-kb', type=float, default=4, help="Size of the model sent to each client")
+    parser.add_argument('--reply-kb', type=float, default=4, help="Size of each client's update")
+    parser.add_argument('--max-uploads', type=int, default=64, help="Concurrent uploads read by the server")
+    parser.add_argument('--extra', type=int, default=0, help="Clients beyond the round size (turned away as busy)")
+    args = parser.parse_args()
+
+    print(f"{'='*86}")
+    print("Event-Driven Server Load Test (loopback)")
+    print(f"Model payload: {args.payload_kb} KB, update: {args.reply_kb} KB, "
+          f"max concurrent uploads: {args.max_uploads}")
+    print(f"{'='*86}")
+    print(f"{'Clients':>8} {'Peak conns':>11} {'Busy':>6} {'Conn/s':>9} {'Round (s)':>10} "
+          f"{'Peak RSS (MB)':>14} {'KB/conn':>9} {'Replies':>8}")
+    for n in args.clients:
+        r = run_load_test(n, int(args.payload_kb * 1024), int(args.reply_kb * 1024), args.max_uploads, args.extra)
+        accepted = r['accepted']
+        print(f"{n:>8} {r['peak_connections']:>11} {r['busy']:>6} {accepted / r['connect_time']:>9.0f} "
+              f"{r['total_time']:>10.2f} {r['peak_rss_kb'] / 1024:>14.1f} "
+              f"{r['rss_growth_kb'] / max(r['peak_connections'], 1):>9.1f} {r['replies']:>8}")
+    print(f"{'='*86}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 import torch
 from torch import nn
 
+GLOBAL_MODEL = 'global_model'  # server -> training client: {'type', 'round', 'model'}
+
 class SimpleNet(nn.Module):
     """Legacy simple model - kept for backward compatibility"""
     def __init__(self):
@@ -29,3 +31,44 @@ class MNISTNet(nn.Module):
         x = self.dropout(x)
         x = self.fc3(x)
         return x
+
+
+def flatten_state_dict(state_dict):
+    """
+    Flatten a state_dict into a single 1-D tensor plus the layout needed to rebuild it
+    
+    Args:
+        state_dict: Model state_dict (name -> tensor)
+        
+    Returns:
+        tuple: (flat float32 tensor, list of (name, shape, dtype) entries)
+    """
+    layout = [(name, tuple(t.shape), t.dtype) for name, t in state_dict.items()]
+    if not layout:
+        return torch.empty(0), layout
+    flat = torch.cat([t.detach().reshape(-1).to(torch.float32) for t in state_dict.values()])
+    return flat, layout
+
+
+def unflatten_state_dict(flat, layout):
+    """
+    Rebuild a state_dict from a flat tensor produced by flatten_state_dict
+    
+    The returned tensors own their memory, so `flat` may be reused or released afterwards.
+    
+    Args:
+        flat: 1-D tensor holding all parameters back to back
+        layout: list of (name, shape, dtype) entries
+        
+    Returns:
+        dict: {name: tensor}
+    """
+    state_dict = {}
+    offset = 0
+    for name, shape, dtype in layout:
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        state_dict[name] = flat[offset:offset + numel].reshape(shape).to(dtype).clone()
+        offset += numel
+    return state_dict
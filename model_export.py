@@ -0,0 +1,190 @@
+"""
+Fast MNISTNet variants for evaluation and inference
+Builds a dynamically quantized int8 model, a frozen TorchScript model and a
+torch.compile'd model from a global state_dict, checks their accuracy against the
+float model on the cached MNIST test set and measures latency per 1000 images.
+
+Usage:
+    python model_export.py                          # export + parity check + benchmark
+    python model_export.py --model global_model.pth --out exports
+"""
+import argparse
+import os
+import time
+import torch
+from torchvision import datasets
+from model_def import MNISTNet
+
+VARIANTS = ('float', 'int8', 'torchscript', 'compiled')
+TEST_CACHE_FILE = 'mnist_test_normalized.pt'
+
+_test_tensors = None
+
+
+def load_test_tensors(data_dir='./data'):
+    """
+    Normalized MNIST test images and labels as two tensors
+
+    The transform is applied once to the whole set and the result is cached on disk and
+    in memory, so repeated evaluations skip the per-image ToTensor/Normalize pipeline.
+
+    Returns:
+        tuple: (images [10000, 1, 28, 28], targets [10000])
+    """
+    global _test_tensors
+    if _test_tensors is not None:
+        return _test_tensors
+
+    cache_path = os.path.join(data_dir, TEST_CACHE_FILE)
+    if os.path.exists(cache_path):
+        _test_tensors = torch.load(cache_path)
+        return _test_tensors
+
+    dataset = datasets.MNIST(data_dir, train=False, download=True)
+    images = ((dataset.data.float() / 255.0 - 0.1307) / 0.3081).unsqueeze(1)
+    _test_tensors = (images, dataset.targets.clone())
+    torch.save(_test_tensors, cache_path)
+    return _test_tensors
+
+
+def build_variant(state_dict, variant='float'):
+    """
+    Build an eval-mode model of the requested variant from a state_dict
+
+    Args:
+        state_dict: Global MNISTNet weights
+        variant: One of VARIANTS
+
+    Returns:
+        Callable model
+    """
+    if variant not in VARIANTS:
+        raise ValueError(f"Unknown model variant '{variant}', expected one of {VARIANTS}")
+    model = MNISTNet()
+    model.load_state_dict(state_dict)
+    model.eval()
+
+    if variant == 'int8':
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if variant == 'torchscript':
+        return torch.jit.freeze(torch.jit.script(model))
+    if variant == 'compiled':
+        return torch.compile(model, dynamic=True)
+    return model
+
+
+def evaluate(model, images, targets, batch_size=1000):
+    """
+    Accuracy and average batch loss of a model on in-memory tensors
+
+    Returns:
+        tuple: (accuracy %, average loss, number of correct predictions)
+    """
+    loss_fn = torch.nn.CrossEntropyLoss()
+    correct = 0
+    test_loss = 0
+    num_batches = 0
+    with torch.inference_mode():
+        for start in range(0, len(targets), batch_size):
+            output = model(images[start:start + batch_size])
+            target = targets[start:start + batch_size]
+            test_loss += loss_fn(output, target).item()
+            correct += (output.argmax(dim=1) == target).sum().item()
+            num_batches += 1
+    return 100. * correct / len(targets), test_loss / num_batches, correct
+
+
+def latency_per_1000(model, images, repeats=20):
+    """Average milliseconds to run 1000 images through the model"""
+    batch = images[:1000]
+    with torch.inference_mode():
+        for _ in range(3):  # Warm-up (also triggers compilation)
+            model(batch)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(batch)
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def check_parity(state_dict, variants=VARIANTS, tolerance=0.5):
+    """
+    Compare each variant's accuracy with the float model on the test set
+
+    Args:
+        tolerance: Maximum allowed accuracy drop in percentage points
+
+    Returns:
+        dict: {variant: {'accuracy', 'loss', 'delta', 'agreement', 'ms_per_1000', 'ok'}}
+    """
+    images, targets = load_test_tensors()
+    float_model = build_variant(state_dict, 'float')
+    with torch.inference_mode():
+        reference = float_model(images).argmax(dim=1)
+    float_accuracy, _, _ = evaluate(float_model, images, targets)
+
+    results = {}
+    for variant in variants:
+        try:
+            model = build_variant(state_dict, variant)
+            accuracy, loss, _ = evaluate(model, images, targets)
+            with torch.inference_mode():
+                agreement = 100. * (model(images).argmax(dim=1) == reference).float().mean().item()
+            results[variant] = {
+                'accuracy': accuracy,
+                'loss': loss,
+                'delta': accuracy - float_accuracy,
+                'agreement': agreement,
+                'ms_per_1000': latency_per_1000(model, images),
+                'ok': float_accuracy - accuracy <= tolerance,
+            }
+        except Exception as e:
+            print(f"WARNING: Variant '{variant}' failed: {e}")
+            results[variant] = None
+    return results
+
+
+def export(state_dict, out_dir='.'):
+    """Save the int8 and TorchScript variants as standalone TorchScript files"""
+    paths = {}
+    for variant in ('int8', 'torchscript'):
+        model = build_variant(state_dict, variant)
+        if variant == 'int8':
+            model = torch.jit.freeze(torch.jit.script(model))
+        path = os.path.join(out_dir, f"global_model_{variant}.pt")
+        torch.jit.save(model, path)
+        paths[variant] = path
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export fast MNISTNet variants")
+    parser.add_argument('--model', default='global_model.pth', help="Global model state_dict")
+    parser.add_argument('--out', default='.', help="Directory for exported models")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        print(f"Error: {args.model} not found!")
+        print("Run the server first to generate the global model.")
+        return
+
+    state_dict = torch.load(args.model, map_location='cpu')
+    os.makedirs(args.out, exist_ok=True)
+    for variant, path in export(state_dict, args.out).items():
+        print(f"✓ {variant} model saved to '{path}'")
+
+    results = check_parity(state_dict)
+    print(f"\n{'='*72}")
+    print("Variant Parity and Latency (MNIST test set)")
+    print(f"{'='*72}")
+    print(f"{'Variant':<12} {'Accuracy':>9} {'Delta':>8} {'Agreement':>10} {'ms/1000 img':>12} {'Parity':>8}")
+    for variant, r in results.items():
+        if r is None:
+            print(f"{variant:<12} {'failed':>9}")
+            continue
+        print(f"{variant:<12} {r['accuracy']:>8.2f}% {r['delta']:>+7.2f} {r['agreement']:>9.2f}% "
+              f"{r['ms_per_1000']:>12.2f} {'✓' if r['ok'] else '✗':>8}")
+    print(f"{'='*72}")
+
+
+if __name__ == "__main__":
+    main()
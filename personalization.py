@@ -0,0 +1,42 @@
+"""
+Personalized federated learning (local heads)
+The layers named in PERSONAL_LAYERS (e.g. fc3) never leave the clients: the server
+only sends, receives and averages the shared body. Each client keeps its own copy of
+the personal layers between rounds, which fits them to its local label distribution.
+Federated evaluation combines them with secure aggregation, so only their average is
+ever revealed.
+"""
+
+
+def parse_layers(spec):
+    """'fc2, fc3' -> ('fc2', 'fc3')"""
+    return tuple(layer.strip() for layer in spec.split(',') if layer.strip())
+
+
+def personal_keys(state_dict, layers):
+    """
+    Parameter names that belong to the given layers
+
+    Args:
+        state_dict: Full model state_dict
+        layers: Layer names such as ('fc3',)
+
+    Returns:
+        set: e.g. {'fc3.weight', 'fc3.bias'}
+    """
+    keys = {name for name in state_dict if name.split('.')[0] in layers}
+    unknown = set(layers) - {name.split('.')[0] for name in keys}
+    if unknown:
+        raise ValueError(f"Unknown personal layers {sorted(unknown)}")
+    return keys
+
+
+def split_state_dict(state_dict, keys):
+    """Split a state_dict into (shared, personal) where personal holds the given keys"""
+    shared = {k: v for k, v in state_dict.items() if k not in keys}
+    personal = {k: v for k, v in state_dict.items() if k in keys}
+    return shared, personal
+
+
+def num_parameters(state_dict):
+    return sum(t.numel() for t in state_dict.values())
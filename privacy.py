@@ -0,0 +1,147 @@
+"""
+Differential privacy utilities for local training (DP-SGD)
+Batches are drawn with Poisson subsampling, per-sample gradients are computed in one
+vectorized pass with torch.func (vmap over grad), clipped to a maximum L2 norm, summed
+and perturbed with Gaussian noise. The privacy budget is tracked with a Renyi DP
+accountant for the subsampled Gaussian mechanism.
+"""
+import json
+import math
+import os
+import torch
+from torch.func import functional_call, grad, vmap
+
+RDP_ORDERS = list(range(2, 128))
+
+
+def make_per_sample_grad_fn(model, loss_fn):
+    """
+    Build a function returning per-sample gradients and outputs for a batch
+
+    Args:
+        model: Model to differentiate (only used for its structure)
+        loss_fn: Loss taking (output, target) for a batch
+
+    Returns:
+        callable: f(params, buffers, data, target) -> ({name: grads[batch, ...]}, outputs[batch, ...])
+    """
+    def compute_loss(params, buffers, x, y):
+        output = functional_call(model, (params, buffers), (x.unsqueeze(0),))
+        return loss_fn(output, y.unsqueeze(0)), output.squeeze(0)
+
+    # Dropout must draw a different mask for every sample
+    return vmap(grad(compute_loss, has_aux=True), in_dims=(None, None, 0, 0), randomness='different')
+
+
+def poisson_batches(images, targets, sample_rate, num_steps):
+    """
+    Batches for DP-SGD drawn with Poisson subsampling
+
+    Every example joins each batch independently with probability sample_rate, which is
+    the sampling the accountant's bound assumes (a shuffled fixed-size DataLoader is not).
+    Batch sizes vary around sample_rate * len(targets) and can be 0.
+    """
+    for _ in range(num_steps):
+        mask = torch.rand(len(targets)) < sample_rate
+        yield images[mask], targets[mask]
+
+
+def dp_sgd_step(model, optimizer, per_sample_grad_fn, data, target, max_grad_norm, noise_multiplier,
+                expected_batch_size):
+    """
+    One DP-SGD step: clip each sample's gradient, add Gaussian noise, update the model
+
+    The noisy sum is divided by the expected batch size, not the sampled one, so the
+    batch size itself reveals nothing. An empty batch still takes a noise-only step.
+
+    Returns:
+        torch.Tensor: model outputs for the batch (for loss/accuracy reporting)
+    """
+    batch_size = data.shape[0]
+    if batch_size == 0:
+        for p in model.parameters():
+            noise = torch.normal(0.0, noise_multiplier * max_grad_norm, size=p.shape)
+            p.grad = noise / expected_batch_size
+        optimizer.step()
+        optimizer.zero_grad()
+        return torch.empty(0)
+
+    params = {name: p.detach() for name, p in model.named_parameters()}
+    buffers = {name: b.detach() for name, b in model.named_buffers()}
+    grads, outputs = per_sample_grad_fn(params, buffers, data, target)
+
+    per_sample_norms = torch.stack(
+        [g.reshape(batch_size, -1).norm(2, dim=1) for g in grads.values()], dim=1).norm(2, dim=1)
+    clip_factors = (max_grad_norm / (per_sample_norms + 1e-6)).clamp(max=1.0)
+
+    for name, p in model.named_parameters():
+        clipped_sum = torch.einsum('i,i...->...', clip_factors, grads[name])
+        noise = torch.normal(0.0, noise_multiplier * max_grad_norm, size=clipped_sum.shape)
+        p.grad = (clipped_sum + noise) / expected_batch_size
+    optimizer.step()
+    optimizer.zero_grad()
+    return outputs.detach()
+
+
+def _log_add(a, b):
+    if a == -math.inf:
+        return b
+    hi, lo = max(a, b), min(a, b)
+    return hi + math.log1p(math.exp(lo - hi))
+
+
+def _compute_rdp(sample_rate, noise_multiplier, order):
+    """RDP of one step of the sampled Gaussian mechanism at an integer order"""
+    if noise_multiplier == 0:
+        return math.inf
+    if sample_rate == 1.0:
+        return order / (2 * noise_multiplier ** 2)
+    log_a = -math.inf
+    for i in range(order + 1):
+        log_coef = (math.lgamma(order + 1) - math.lgamma(i + 1) - math.lgamma(order - i + 1)
+                    + i * math.log(sample_rate) + (order - i) * math.log(1 - sample_rate))
+        log_a = _log_add(log_a, log_coef + (i * i - i) / (2 * noise_multiplier ** 2))
+    return log_a / (order - 1)
+
+
+class RDPAccountant:
+    """Renyi DP accountant that composes DP-SGD steps across rounds"""
+
+    def __init__(self, history=None):
+        # Entries of [noise_multiplier, sample_rate, num_steps]
+        self.history = history or []
+
+    def step(self, noise_multiplier, sample_rate, num_steps=1):
+        if self.history and self.history[-1][:2] == [noise_multiplier, sample_rate]:
+            self.history[-1][2] += num_steps
+        else:
+            self.history.append([noise_multiplier, sample_rate, num_steps])
+
+    def get_epsilon(self, delta):
+        """
+        Convert the accumulated RDP into (epsilon, delta)-DP
+
+        Returns:
+            tuple: (epsilon, best RDP order)
+        """
+        if not self.history:
+            return 0.0, None
+        best_eps, best_order = math.inf, None
+        for order in RDP_ORDERS:
+            rdp = sum(steps * _compute_rdp(q, sigma, order) for sigma, q, steps in self.history)
+            eps = rdp + math.log1p(-1 / order) - (math.log(delta) + math.log(order)) / (order - 1)
+            if eps < best_eps:
+                best_eps, best_order = eps, order
+        return max(best_eps, 0.0), best_order
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'history': self.history}, f, indent=2)
+
+    @classmethod
+    def load(cls, path):
+        """Load a saved accountant, or start a fresh one if the file does not exist"""
+        if not os.path.exists(path):
+            return cls()
+        with open(path, 'r') as f:
+            return cls(json.load(f)['history'])
@@ -0,0 +1,143 @@
+"""
+Opt-in profiling of the round hot paths
+With PROFILE=1 every round is recorded with torch.profiler and cProfile and written to
+PROFILE_DIR as a Chrome trace (open in chrome://tracing or https://ui.perfetto.dev),
+a raw cProfile dump and a text summary with per-stage wall time, the top torch ops and
+the top Python functions. Stages are the functions decorated with @profiled plus the
+section() blocks inside them (data loading, forward, backward, serialization, network).
+
+cProfile only sees the thread that started the round, so the server evaluates each
+round synchronously while profiling instead of on its background thread.
+
+When PROFILE is off, @profiled returns the function unchanged and section() returns a
+shared no-op context manager, so the hot paths run as before.
+"""
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+PROFILE = os.environ.get("PROFILE", "0") == "1"
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+_NULL_SECTION = contextlib.nullcontext()
+_current = None
+
+
+class RoundProfile:
+    """torch.profiler + cProfile session and per-stage timings for one round"""
+
+    def __init__(self, label):
+        import torch
+        self.label = label
+        self.stages = defaultdict(lambda: [0, 0.0])   # stage -> [calls, seconds]
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.cprofile = cProfile.Profile()
+        self.torch_profile = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU])
+        self.torch_profile.__enter__()
+        self.cprofile.enable()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            entry = self.stages[stage]
+            entry[0] += 1
+            entry[1] += seconds
+
+    def finish(self):
+        """Stop profiling and write the trace, cProfile dump and summary; returns the summary path"""
+        self.cprofile.disable()
+        self.torch_profile.__exit__(None, None, None)
+        elapsed = time.perf_counter() - self.started
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, self.label)
+
+        self.torch_profile.export_chrome_trace(base + "_trace.json")
+        self.cprofile.dump_stats(base + ".prof")
+
+        lines = [f"Profile: {self.label} ({elapsed:.3f}s wall)", "",
+                 "Stages (inclusive wall time)",
+                 f"{'Stage':<24} {'Calls':>8} {'Total (s)':>10} {'Mean (ms)':>10} {'% round':>8}"]
+        for stage, (calls, seconds) in sorted(self.stages.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{stage:<24} {calls:>8} {seconds:>10.3f} {seconds / calls * 1000:>10.2f} "
+                         f"{100. * seconds / elapsed:>7.1f}%")
+        lines += ["", "Top torch ops (self CPU time)",
+                  self.torch_profile.key_averages().table(sort_by="self_cpu_time_total", row_limit=15)]
+        stream = io.StringIO()
+        pstats.Stats(self.cprofile, stream=stream).sort_stats("cumulative").print_stats(25)
+        lines += ["Top Python functions (cumulative time)", stream.getvalue()]
+        with open(base + "_summary.txt", "w") as f:
+            f.write("\n".join(lines))
+        return base + "_summary.txt"
+
+
+def start_round(label):
+    """Start profiling a round (ends the previous one if it is still open)"""
+    global _current
+    if not PROFILE:
+        return
+    end_round()
+    _current = RoundProfile(label)
+
+
+def end_round():
+    global _current
+    if _current is None:
+        return
+    profile, _current = _current, None
+    path = profile.finish()
+    print(f"✓ Profile for {profile.label} written to '{path}'")
+
+
+@contextlib.contextmanager
+def _timed(stage, profile):
+    import torch
+    start = time.perf_counter()
+    try:
+        with torch.profiler.record_function(stage):
+            yield
+    finally:
+        profile.record(stage, time.perf_counter() - start)
+
+
+def section(stage):
+    """Context manager that times a block as a stage of the round it started in (no-op unless profiling)"""
+    profile = _current
+    if profile is None:
+        return _NULL_SECTION
+    return _timed(stage, profile)
+
+
+def timed_iter(iterable, stage):
+    """Iterate while timing each fetch as a stage, e.g. DataLoader batches"""
+    if not PROFILE:
+        return iterable
+    return _timed_iter(iterable, stage)
+
+
+def _timed_iter(iterable, stage):
+    iterator = iter(iterable)
+    while True:
+        with section(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def profiled(fn):
+    """Decorator recording every call of fn as a stage named after it (identity unless PROFILE=1)"""
+    if not PROFILE:
+        return fn
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        with section(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,343 @@
+"""
+Secure aggregation with pairwise additive masking
+Each pair of clients agrees on a seed (Diffie-Hellman), expands it into a mask over the
+flat parameter vector and one side adds it while the other subtracts it, so the masks
+cancel in the sum and the server only ever sees the aggregate. Every client Shamir-shares
+its DH secret with its neighbours, which lets the server remove the masks of clients
+that drop out after masking.
+
+Each client also adds a private self-mask expanded from a random seed b_i, which it
+shares the same way (double masking, Bonawitz et al. 2017). In the unmasking step a
+survivor reveals, for each neighbour, either the share of its b (the neighbour delivered)
+or the share of its DH secret (the neighbour dropped), never both. A server that falsely
+reports a delivered client as dropped can remove its pairwise masks but not its
+self-mask, so it still learns nothing about that client's update.
+
+Updates are quantized to 64-bit fixed point so that masking and summation wrap
+modulo 2^64 and cancel exactly. Masks are generated in one call per pair with
+numpy's PCG64 bit generator; nothing is done per element in Python.
+
+The server is trusted to relay messages (public keys are not signed), so this protects
+against a server that inspects what it receives and lies about dropouts, not one that
+substitutes keys.
+"""
+import hashlib
+import math
+import secrets
+import numpy as np
+import torch
+from model_def import flatten_state_dict, unflatten_state_dict
+
+# RFC 3526 group 14 (2048-bit MODP), generator 2
+DH_PRIME = int(
+    "FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBEA63B139B22514A08798E3404DD"
+    "EF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+    "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF0598DA48361C55D39A69163FA8FD24CF5F"
+    "83655D23DCA3AD961C62F356208552BB9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B"
+    "E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF6955817183995497CEA956AE515D2261898FA0510"
+    "15728E5A8AACAA68FFFFFFFFFFFFFFFF", 16)
+DH_GENERATOR = 2
+SHARE_PRIME = 2 ** 521 - 1   # Mersenne prime, larger than any DH secret
+FIXED_POINT_BITS = 24        # Quantization precision of the masked updates
+
+SECAGG_SETUP = 'secagg_setup'    # server -> client: index in this round, asks for a public key
+SECAGG_KEYS = 'secagg_keys'      # server -> client: neighbours' public keys, asks for secret shares
+SECAGG_TRAIN = 'secagg_train'    # server -> client: global model + shares addressed to this client
+SECAGG_UNMASK = 'secagg_unmask'  # server -> client: dropped and delivered neighbours whose shares are needed
+
+
+def default_num_neighbors(num_clients):
+    """
+    Number of masking neighbours per client
+
+    Small federations mask with every other client. Larger ones use a ring of
+    O(log n) neighbours so that the per-client cost stays flat as n grows.
+    """
+    if num_clients <= 32:
+        return num_clients - 1
+    return min(num_clients - 1, 2 * math.ceil(math.log2(num_clients)))
+
+
+def neighbor_indices(position, members, num_neighbors=None):
+    """
+    Neighbours of members[position] on a ring over `members`
+
+    Returns:
+        list: client indices this client masks with (symmetric relation)
+    """
+    n = len(members)
+    if num_neighbors is None:
+        num_neighbors = default_num_neighbors(n)
+    if num_neighbors >= n - 1:
+        return [m for k, m in enumerate(members) if k != position]
+    half = max(1, num_neighbors // 2)
+    offsets = set()
+    for step in range(1, half + 1):
+        offsets.add(step)
+        offsets.add(n - step)
+    return sorted(members[(position + o) % n] for o in offsets)
+
+
+def generate_keypair():
+    """Generate a Diffie-Hellman key pair (secret, public)"""
+    secret = secrets.randbits(256)
+    return secret, pow(DH_GENERATOR, secret, DH_PRIME)
+
+
+def agree(secret, peer_public):
+    """Shared key between two clients from one's secret and the other's public key"""
+    shared = pow(peer_public, secret, DH_PRIME)
+    return hashlib.sha256(shared.to_bytes(256, 'big')).digest()
+
+
+def mask_seed(key, round_id):
+    """Seed of the pairwise mask for one round"""
+    digest = hashlib.sha256(key + b'mask' + round_id.to_bytes(8, 'big')).digest()
+    return int.from_bytes(digest[:16], 'big')
+
+
+def expand_mask(seed, size):
+    """Expand a seed into `size` uniformly random uint64 values in a single call"""
+    return np.random.PCG64(seed).random_raw(size)
+
+
+def _keystream(key, purpose, length):
+    return hashlib.shake_256(key + purpose).digest(length)
+
+
+def encrypt_share(key, share, purpose=b'share'):
+    """Encrypt a secret share for its recipient using the pairwise key (one keystream per purpose)"""
+    data = share.to_bytes(66, 'big')
+    return bytes(a ^ b for a, b in zip(data, _keystream(key, purpose, len(data))))
+
+
+def decrypt_share(key, data, purpose=b'share'):
+    """Inverse of encrypt_share"""
+    return int.from_bytes(bytes(a ^ b for a, b in zip(data, _keystream(key, purpose, len(data)))), 'big')
+
+
+def shamir_split(secret, xs, threshold):
+    """
+    Split a secret into Shamir shares over GF(SHARE_PRIME)
+
+    Args:
+        secret: Integer secret
+        xs: Non-zero x coordinates, one per recipient
+        threshold: Number of shares needed to reconstruct
+
+    Returns:
+        dict: {x: share}
+    """
+    coeffs = [secret] + [secrets.randbelow(SHARE_PRIME) for _ in range(threshold - 1)]
+    shares = {}
+    for x in xs:
+        y = 0
+        for c in reversed(coeffs):
+            y = (y * x + c) % SHARE_PRIME
+        shares[x] = y
+    return shares
+
+
+def shamir_reconstruct(shares):
+    """Recover the secret from a {x: share} dict with at least `threshold` entries"""
+    secret = 0
+    for xi, yi in shares.items():
+        num, den = 1, 1
+        for xj in shares:
+            if xj != xi:
+                num = num * -xj % SHARE_PRIME
+                den = den * (xi - xj) % SHARE_PRIME
+        secret = (secret + yi * num * pow(den, -1, SHARE_PRIME)) % SHARE_PRIME
+    return secret
+
+
+def quantize(flat):
+    """Map a float tensor to 64-bit fixed point (two's complement in uint64)"""
+    scaled = np.rint(flat.double().numpy() * (1 << FIXED_POINT_BITS))
+    return scaled.astype(np.int64).view(np.uint64)
+
+
+def dequantize(total, count):
+    """Average of `count` quantized vectors from their wrapped uint64 sum"""
+    return torch.from_numpy(total.view(np.int64).astype(np.float64) / (1 << FIXED_POINT_BITS) / count)
+
+
+class SecureAggClient:
+    """Client side of one secure aggregation round"""
+
+    def __init__(self, index, round_id):
+        self.index = index
+        self.round_id = round_id
+        self.secret, self.public_key = generate_keypair()
+        self.self_seed = secrets.randbits(128)   # b_i, seed of the self-mask
+        self.keys = {}          # neighbour index -> pairwise key
+        self.held_shares = {}   # neighbour index -> (share of their DH secret, share of their b)
+        self.revealed = set()   # neighbours whose shares were already revealed this round
+
+    def share_secret(self, public_keys, threshold):
+        """
+        Agree keys with neighbours and share our DH secret and self-mask seed
+
+        Returns:
+            dict: {neighbour: (encrypted DH secret share, encrypted self-mask seed share)}
+        """
+        self.keys = {j: agree(self.secret, pk) for j, pk in public_keys.items()}
+        xs = [j + 1 for j in self.keys]
+        secret_shares = shamir_split(self.secret, xs, threshold)
+        seed_shares = shamir_split(self.self_seed, xs, threshold)
+        return {j: (encrypt_share(key, secret_shares[j + 1]), encrypt_share(key, seed_shares[j + 1], b'self'))
+                for j, key in self.keys.items()}
+
+    def receive_shares(self, encrypted_shares):
+        """Decrypt and keep the shares other clients addressed to us"""
+        self.held_shares = {j: (decrypt_share(self.keys[j], secret), decrypt_share(self.keys[j], seed, b'self'))
+                            for j, (secret, seed) in encrypted_shares.items() if j in self.keys}
+
+    def mask(self, state_dict, neighbors):
+        """
+        Quantize and mask the update
+
+        Args:
+            state_dict: Locally trained model
+            neighbors: Neighbours that are still part of the round
+
+        Returns:
+            np.ndarray: masked uint64 vector
+        """
+        flat, _ = flatten_state_dict(state_dict)
+        masked = quantize(flat)
+        masked += expand_mask(self.self_seed, masked.size)
+        for j in neighbors:
+            m = expand_mask(mask_seed(self.keys[j], self.round_id), masked.size)
+            if self.index < j:
+                masked += m
+            else:
+                masked -= m
+        return masked
+
+    def reveal(self, dropped, delivered):
+        """
+        Shares needed to unmask the sum
+
+        Args:
+            dropped: Neighbours that did not deliver (their DH secret shares are revealed)
+            delivered: Neighbours that delivered (their self-mask seed shares are revealed)
+
+        Returns:
+            dict: {'secrets': {dropped: share}, 'seeds': {delivered: share}}
+        """
+        dropped, delivered = set(dropped), set(delivered)
+        if dropped & delivered or (dropped | delivered) & self.revealed:
+            # Both shares of one client would let the server strip all of its masks
+            raise ValueError("Refusing to reveal both shares of the same client")
+        self.revealed |= dropped | delivered
+        return {
+            'secrets': {d: self.held_shares[d][0] for d in dropped if d in self.held_shares},
+            'seeds': {c: self.held_shares[c][1] for c in delivered if c in self.held_shares},
+        }
+
+
+class SecureAggregator:
+    """Server side of one secure aggregation round"""
+
+    def __init__(self, round_id, num_neighbors=None):
+        self.round_id = round_id
+        self.num_neighbors = num_neighbors
+        self.public_keys = {}
+        self.neighbors = {}
+        self.thresholds = {}
+        self.layout = None
+        self.total = None
+        self.contributors = []
+
+    def set_public_keys(self, public_keys):
+        """Fix the round's members and their neighbourhoods from the advertised keys"""
+        self.public_keys = dict(public_keys)
+        members = sorted(self.public_keys)
+        for pos, i in enumerate(members):
+            self.neighbors[i] = neighbor_indices(pos, members, self.num_neighbors)
+            self.thresholds[i] = len(self.neighbors[i]) // 2 + 1
+
+    def keys_for(self, i):
+        """Control message carrying client i's neighbours' public keys"""
+        return {
+            'type': SECAGG_KEYS,
+            'public_keys': {j: self.public_keys[j] for j in self.neighbors[i]},
+            'threshold': self.thresholds[i],
+        }
+
+    def route_shares(self, shares_by_sender):
+        """
+        Re-address encrypted shares from senders to recipients
+
+        Clients that did not send shares are dropped from the round.
+
+        Returns:
+            dict: {recipient: {sender: encrypted share}}
+        """
+        members = set(shares_by_sender)
+        self.neighbors = {i: [j for j in nbrs if j in members]
+                          for i, nbrs in self.neighbors.items() if i in members}
+        inbox = {i: {} for i in members}
+        for sender, shares in shares_by_sender.items():
+            for recipient, data in shares.items():
+                if recipient in inbox:
+                    inbox[recipient][sender] = data
+        return inbox
+
+    def add(self, i, masked):
+        """Accumulate a masked update (running sum, nothing is kept per client)"""
+        if self.total is None:
+            self.total = masked.copy()
+        else:
+            self.total += masked
+        self.contributors.append(i)
+
+    def dropped(self):
+        """Clients that shared keys but did not deliver a masked update"""
+        return sorted(set(self.neighbors) - set(self.contributors))
+
+    def unmask_request(self, i):
+        """Control message asking survivor i for the shares of its dropped and delivered neighbours"""
+        dropped = set(self.dropped())
+        contributors = set(self.contributors)
+        return {
+            'type': SECAGG_UNMASK,
+            'dropped': [j for j in self.neighbors[i] if j in dropped],
+            'delivered': [j for j in self.neighbors[i] if j in contributors],
+        }
+
+    def unmask(self, revealed, layout):
+        """
+        Remove the self-masks of contributors and the masks left by dropped clients,
+        and return the averaged state_dict
+
+        Args:
+            revealed: {survivor: reveal() result} returned by the survivors
+            layout: Parameter layout from flatten_state_dict
+        """
+        if not self.contributors:
+            raise ValueError("No masked updates to aggregate")
+        survivors = set(self.contributors)
+        for c in self.contributors:
+            shares = {s + 1: revealed[s]['seeds'][c] for s in revealed if c in revealed[s]['seeds']}
+            if len(shares) < self.thresholds[c]:
+                raise RuntimeError(f"Not enough shares to remove the self-mask of client {c}")
+            self.total -= expand_mask(shamir_reconstruct(shares), self.total.size)
+        for d in self.dropped():
+            shares = {s + 1: revealed[s]['secrets'][d] for s in revealed if d in revealed[s]['secrets']}
+            if len(shares) < self.thresholds[d]:
+                raise RuntimeError(f"Not enough shares to recover dropped client {d}")
+            secret = shamir_reconstruct(shares)
+            for i in self.neighbors[d]:
+                if i not in survivors:
+                    continue
+                key = agree(secret, self.public_keys[i])
+                m = expand_mask(mask_seed(key, self.round_id), self.total.size)
+                # Survivor i added +m if i < d and -m otherwise; undo it
+                if i < d:
+                    self.total -= m
+                else:
+                    self.total += m
+        flat = dequantize(self.total, len(self.contributors))
+        return unflatten_state_dict(flat, layout)
@@ -3,16 +3,35 @@ import pickle
 import torch
 import os
 import json
+import queue
+import threading
 from datetime import datetime
-from torch.utils.data import DataLoader
-from torchvision import datasets, transforms
-from model_def import MNISTNet
+from model_def import MNISTNet, flatten_state_dict, GLOBAL_MODEL
+from model_export import load_test_tensors, build_variant, evaluate
+from shm_transport import SharedModelStore, is_local_peer, SHM_UPDATE
+from secure_agg import SecureAggregator, SECAGG_SETUP, SECAGG_TRAIN
+from federated_eval import FED_EVAL, combine_counts
+from event_server import EventServer
+import profiling
+from personalization import parse_layers, personal_keys, split_state_dict, num_parameters
 
 HOST = os.environ.get("SERVER_HOST", "0.0.0.0")
 PORT = int(os.environ.get("SERVER_PORT", "5000"))
 NUM_CLIENTS = int(os.environ.get("NUM_CLIENTS", "2"))
 MIN_CLIENTS = int(os.environ.get("MIN_CLIENTS", "2"))  # Minimum clients required per round
+SHM_TRANSPORT = os.environ.get("SHM_TRANSPORT", "0") == "1"  # Shared memory for same-host clients
+SECURE_AGG = os.environ.get("SECURE_AGG", "0") == "1"  # Pairwise-masked updates, server only sees the sum
+EVAL_VARIANT = os.environ.get("EVAL_VARIANT", "float")  # float, int8, torchscript or compiled
+ASYNC_EVAL = os.environ.get("ASYNC_EVAL", "1") == "1"  # Evaluate on a background thread while the next round runs
+FED_EVAL_EVERY = int(os.environ.get("FED_EVAL_EVERY", "0"))  # Federated evaluation round after every N rounds (0 = off)
+FED_EVAL_CLIENTS = int(os.environ.get("FED_EVAL_CLIENTS", str(NUM_CLIENTS)))  # Clients scoring each evaluation
+EVENT_SERVER = os.environ.get("EVENT_SERVER", "0") == "1"  # Serve each round's clients concurrently from one selector loop
+ROUND_TIMEOUT = float(os.environ.get("ROUND_TIMEOUT", "0"))  # Seconds before an event-driven round closes (0 = wait for all)
+LISTEN_BACKLOG = int(os.environ.get("LISTEN_BACKLOG", "1024"))  # Pending connections queued by the kernel in event mode
+PERSONAL_LAYERS = parse_layers(os.environ.get("PERSONAL_LAYERS", ""))  # e.g. "fc3": layers kept on each client
+HISTORY_LOG = "training_history.jsonl"  # Append-only per-round metrics, tailed by visualize_training.py --live
 
+@profiling.profiled
 def receive_data(sock):
     """Receive data with length prefix"""
     try:
@@ -38,15 +57,19 @@ def receive_data(sock):
     except Exception as e:
         raise RuntimeError(f"Error receiving data: {e}")
 
+@profiling.profiled
 def send_data(sock, data):
     """Send data with length prefix"""
     try:
-        data_bytes = pickle.dumps(data)
+        with profiling.section('serialize'):
+            data_bytes = pickle.dumps(data)
         length_bytes = len(data_bytes).to_bytes(4, 'big')
-        sock.sendall(length_bytes + data_bytes)
+        with profiling.section('network_send'):
+            sock.sendall(length_bytes + data_bytes)
     except Exception as e:
         raise RuntimeError(f"Error sending data: {e}")
 
+@profiling.profiled
 def aggregate_models(client_weights):
     """Average model weights from all clients"""
     if not client_weights:
@@ -57,55 +80,406 @@ def aggregate_models(client_weights):
         new_state[key] = sum([w[key] for w in client_weights]) / len(client_weights)
     return new_state
 
+@profiling.profiled
 def evaluate_model(model):
     """Evaluate global model on MNIST test set"""
     print("Evaluating model on test set...")
     
-    transform = transforms.Compose([
-        transforms.ToTensor(),
-        transforms.Normalize((0.1307,), (0.3081,))
-    ])
+    # Test set is normalized once and cached as tensors; EVAL_VARIANT picks a fast model variant
+    images, targets = load_test_tensors()
+    model.eval()
+    eval_model = model if EVAL_VARIANT == 'float' else build_variant(model.state_dict(), EVAL_VARIANT)
+    accuracy, avg_loss, correct = evaluate(eval_model, images, targets)
     
-    test_dataset = datasets.MNIST('./data', train=False, download=True, transform=transform)
-    test_loader = DataLoader(test_dataset, batch_size=1000, shuffle=False)
+    print(f"Test Set: Average loss: {avg_loss:.4f}, Accuracy: {correct}/{len(targets)} ({accuracy:.2f}%)")
     
-    model.eval()
-    correct = 0
-    total = 0
-    test_loss = 0
-    loss_fn = torch.nn.CrossEntropyLoss()
+    return accuracy, avg_loss
+
+def append_history_log(record, mode='a'):
+    """Write one JSON record to the live log (mode 'w' starts a new run)"""
+    with open(HISTORY_LOG, mode) as f:
+        f.write(json.dumps({**record, 'timestamp': datetime.now().isoformat()}) + "\n")
+
+def record_round(training_history, round_num, accuracy, avg_loss, num_clients):
+    """Add a round's metrics to the history and append them to the live log"""
+    training_history['rounds'].append(round_num)
+    training_history['accuracies'].append(accuracy)
+    training_history['losses'].append(avg_loss)
+    training_history['num_clients'].append(num_clients)
+    append_history_log({
+        'type': 'round',
+        'round': round_num,
+        'accuracy': accuracy,
+        'loss': avg_loss,
+        'num_clients': num_clients,
+    })
+
+def record_federated_eval(training_history, round_num, metrics):
+    """Add a federated evaluation's metrics to the history and the live log"""
+    training_history['federated_eval'].append({'round': round_num, **metrics})
+    append_history_log({'type': 'federated_eval', 'round': round_num, **metrics})
+
+def finish_evaluation(training_history, model, round_num, num_clients):
+    """Evaluate an aggregated model and record the round's metrics"""
+    accuracy, avg_loss = evaluate_model(model)
+    record_round(training_history, round_num, accuracy, avg_loss, num_clients)
+    print(f"[Round {round_num}] ✓ Accuracy: {accuracy:.2f}%, Loss: {avg_loss:.4f}")
+
+class BackgroundEvaluator:
+    """Evaluates snapshots of the global model on a worker thread
     
-    with torch.no_grad():
-        for data, target in test_loader:
-            output = model(data)
-            test_loss += loss_fn(output, target).item()
-            pred = output.argmax(dim=1, keepdim=True)
-            correct += pred.eq(target.view_as(pred)).sum().item()
-            total += target.size(0)
+    The training loop only hands over a copy of the aggregated weights and moves on to
+    the next round. A single worker consumes snapshots in submission order, so metrics
+    are appended to the history (and the live log) in round order.
+    """
     
-    accuracy = 100. * correct / total
-    avg_loss = test_loss / len(test_loader)
+    def __init__(self, training_history):
+        self.training_history = training_history
+        self.snapshots = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
     
-    print(f"Test Set: Average loss: {avg_loss:.4f}, Accuracy: {correct}/{total} ({accuracy:.2f}%)")
+    def submit(self, round_num, state_dict, num_clients):
+        snapshot = {k: v.detach().clone() for k, v in state_dict.items()}
+        self.snapshots.put((round_num, snapshot, num_clients))
     
-    return accuracy, avg_loss
+    def _run(self):
+        model = MNISTNet()
+        while True:
+            item = self.snapshots.get()
+            if item is None:
+                break
+            round_num, snapshot, num_clients = item
+            try:
+                model.load_state_dict(snapshot)
+                finish_evaluation(self.training_history, model, round_num, num_clients)
+            except Exception as e:
+                print(f"ERROR: Evaluation of round {round_num} failed: {e}")
+    
+    def close(self):
+        """Wait until every submitted round has been evaluated"""
+        self.snapshots.put(None)
+        self.worker.join()
+
+def model_message(round_num, global_state):
+    """Message carrying the global model to training clients; they record the round as its version"""
+    return {'type': GLOBAL_MODEL, 'round': round_num, 'model': global_state}
+
+def collect_client_updates(server, round_num, global_state, shm_store=None):
+    """Send the global model to NUM_CLIENTS clients in turn and collect their trained weights"""
+    message = model_message(round_num, global_state)
+    client_weights = []
+    for i in range(NUM_CLIENTS):
+        conn = None
+        try:
+            print(f"[Round {round_num}] Waiting for client {i+1}/{NUM_CLIENTS}...")
+            conn, addr = server.accept()
+            conn.settimeout(120)  # 2 minute timeout per client
+            print(f"[Round {round_num}] Client {i+1}/{NUM_CLIENTS} connected from {addr}")
+
+            if shm_store is not None and is_local_peer(conn, addr):
+                # Same host: only control messages go over the socket
+                print(f"[Round {round_num}] Offering shared memory exchange to client {i+1}...")
+                updated_weights = exchange_via_shm(conn, shm_store, i, message)
+            else:
+                # Send global model
+                print(f"[Round {round_num}] Sending global model to client {i+1}...")
+                send_data(conn, message)
+                print(f"[Round {round_num}] Global model sent to client {i+1}")
+
+                # Receive updated weights
+                print(f"[Round {round_num}] Waiting for updates from client {i+1}...")
+                recv_data = receive_data(conn)
+                with profiling.section('deserialize'):
+                    updated_weights = pickle.loads(recv_data)
+            client_weights.append(updated_weights)
+            print(f"[Round {round_num}] Received updates from client {i+1}")
+            
+        except socket.timeout:
+            print(f"ERROR: Client {i+1} timed out")
+        except Exception as e:
+            print(f"ERROR: Failed to process client {i+1}: {e}")
+        finally:
+            if conn:
+                conn.close()
+    return client_weights
+
+def collect_client_updates_event(event_server, round_num, global_state):
+    """Serve all NUM_CLIENTS clients of a round concurrently and collect their trained weights"""
+    print(f"[Round {round_num}] Serving global model to {NUM_CLIENTS} clients (event loop)...")
+    timeout = ROUND_TIMEOUT or None
+    replies = event_server.run_round(model_message(round_num, global_state), NUM_CLIENTS, round_timeout=timeout)
+    stats = event_server.stats
+    print(f"[Round {round_num}] Connections accepted: {stats['accepted']}, turned away: {stats['rejected']}, "
+          f"peak concurrent: {stats['peak_connections']}")
+    return [weights for _, weights in replies]
+
+def shared_state(model):
+    """The part of the global model exchanged with clients (all of it unless PERSONAL_LAYERS is set)"""
+    state_dict = model.state_dict()
+    if not PERSONAL_LAYERS:
+        return state_dict
+    shared, _ = split_state_dict(state_dict, personal_keys(state_dict, PERSONAL_LAYERS))
+    return shared
+
+def add_eval_report(reports, report, round_num):
+    """Key a client's evaluation counts by its own client ID, skipping duplicates and empty held-out slices"""
+    # Key by the client's own ID so per-client accuracy can be followed across rounds
+    client_id = report.pop('client_id')
+    if client_id in reports:
+        print(f"WARNING: Client ID {client_id} reported twice, keeping the first report")
+        return
+    if report['total'] == 0:
+        print(f"WARNING: Client ID {client_id} has no held-out samples (HOLDOUT_FRACTION is 0 on that client)")
+        return
+    reports[client_id] = report
+    print(f"[Eval {round_num}] Client ID {client_id} scored {report['total']} held-out samples")
+
+def federated_evaluation_round(server, round_num, global_model):
+    """Have clients score the global model on their held-out data and combine their counts
+    
+    In personalized mode clients score the shared body with their own personal layers.
+    The personal layers are combined with secure aggregation, so the server only learns
+    their average, which it pairs with the body on a copy of the global model to also
+    report the global body's accuracy on the central test set.
+    
+    Returns:
+        (dict of fleet-wide metrics or None if no client reported,
+         averaged personal layers or None)
+    """
+    global_state = shared_state(global_model)
+    reports = {}
+    averaged_layers = None
+    if PERSONAL_LAYERS:
+        state_dict = global_model.state_dict()
+        _, template = split_state_dict(state_dict, personal_keys(state_dict, PERSONAL_LAYERS))
+        try:
+            averaged_layers, num_contributors = secure_aggregation_round(
+                server, round_num, global_state, FED_EVAL_CLIENTS, task=FED_EVAL, template=template,
+                on_reply=lambda i, reply: add_eval_report(reports, reply['counts'], round_num))
+            if averaged_layers is None:
+                print(f"WARNING: Only {num_contributors} clients sent personal layers, but {MIN_CLIENTS} required. "
+                      f"Skipping global body accuracy for round {round_num}.")
+        except Exception as e:
+            print(f"ERROR: Federated evaluation failed: {e}")
+    else:
+        for i in range(FED_EVAL_CLIENTS):
+            conn = None
+            try:
+                print(f"[Eval {round_num}] Waiting for client {i+1}/{FED_EVAL_CLIENTS}...")
+                conn, addr = server.accept()
+                conn.settimeout(120)
+                send_data(conn, {'type': FED_EVAL, 'round': round_num, 'model': global_state})
+                add_eval_report(reports, pickle.loads(receive_data(conn)), round_num)
+            except Exception as e:
+                print(f"ERROR: Federated evaluation failed for client {i+1}: {e}")
+            finally:
+                if conn:
+                    conn.close()
+    
+    if not reports:
+        return None, averaged_layers
+    metrics = combine_counts(reports)
+    per_class = ", ".join(f"{c}: {a:.1f}%" for c, a in enumerate(metrics['per_class_accuracy']) if a is not None)
+    label = "Personalized" if PERSONAL_LAYERS else "Federated"
+    print(f"[Eval {round_num}] ✓ {label} accuracy: {metrics['accuracy']:.2f}%, Loss: {metrics['loss']:.4f} "
+          f"({metrics['samples']} samples on {len(reports)} clients)")
+    print(f"[Eval {round_num}]   Per class: {per_class}")
+    print(f"[Eval {round_num}]   Worst client: ID {metrics['worst_client']} "
+          f"({metrics['worst_client_accuracy']:.2f}%)")
+    
+    if averaged_layers is not None:
+        accuracy, loss = evaluate_model(with_personal_layers(global_model, averaged_layers))
+        metrics['global_body_accuracy'] = accuracy
+        metrics['global_body_loss'] = loss
+        print(f"[Eval {round_num}] ✓ Global body accuracy (averaged personal layers): {accuracy:.2f}%, "
+              f"Loss: {loss:.4f}")
+    return metrics, averaged_layers
+
+def with_personal_layers(global_model, personal_layers):
+    """Copy of the global model with the given personal layers in place of the server's untrained ones"""
+    model = MNISTNet()
+    model.load_state_dict(global_model.state_dict())
+    model.load_state_dict(personal_layers, strict=False)
+    return model
+
+def save_checkpoint(model, path="global_model.pth"):
+    """Atomically replace the global model checkpoint (read by the inference server)"""
+    tmp_path = path + ".tmp"
+    torch.save(model.state_dict(), tmp_path)
+    os.replace(tmp_path, path)
+
+def publish_checkpoint(global_model, averaged_layers=None):
+    """Write the checkpoint served by inference_server.py; returns False if nothing was written
+    
+    In personalized mode the server's own personal layers are never trained, so the
+    checkpoint uses the personal layers averaged at the latest federated evaluation and
+    is skipped until one has produced them.
+    """
+    if not PERSONAL_LAYERS:
+        save_checkpoint(global_model)
+        return True
+    if averaged_layers is None:
+        print("WARNING: No averaged personal layers yet (they come from federated evaluation), "
+              "checkpoint not written")
+        return False
+    save_checkpoint(with_personal_layers(global_model, averaged_layers))
+    return True
+
+def exchange_via_shm(conn, shm_store, slot_id, message):
+    """Exchange models with a same-host client through shared memory
+    
+    Falls back to sending the model over the socket if the client cannot attach.
+    """
+    send_data(conn, shm_store.offer(slot_id))
+    reply = pickle.loads(receive_data(conn))
+    if isinstance(reply, dict) and reply.get('type') == SHM_UPDATE:
+        return shm_store.read_slot(slot_id)
+    
+    print("Client could not attach to shared memory, falling back to socket transfer")
+    send_data(conn, message)
+    return pickle.loads(receive_data(conn))
+
+def secure_aggregation_round(server, round_id, global_state, num_clients=NUM_CLIENTS, task=None,
+                             template=None, on_reply=None):
+    """Run one round where clients send pairwise-masked updates
+    
+    All clients stay connected for the whole round: they advertise public keys,
+    exchange secret shares through the server, train and send masked updates,
+    then reveal the shares needed to remove the survivors' self-masks and the
+    pairwise masks of clients that dropped.
+    
+    Args:
+        task: Sent to clients with the model; FED_EVAL asks them to evaluate and mask
+              their personal layers instead of training
+        template: state_dict with the layout of the masked vectors (default: global_state)
+        on_reply: Optional function (index, reply) called with each client's masked reply
+    
+    Returns:
+        (averaged state or None, number of contributing clients)
+    """
+    aggregator = SecureAggregator(round_id)
+    conns = {}
+    
+    def exchange(i, message, phase):
+        """Send a control message to client i and return its reply, dropping it on failure"""
+        try:
+            send_data(conns[i], message)
+            return pickle.loads(receive_data(conns[i]))
+        except Exception as e:
+            print(f"ERROR: Client {i+1} dropped during {phase}: {e}")
+            conns.pop(i).close()
+            return None
+    
+    try:
+        for i in range(num_clients):
+            print(f"[Round {round_id}] Waiting for client {i+1}/{num_clients}...")
+            conn, addr = server.accept()
+            conn.settimeout(120)
+            conns[i] = conn
+            print(f"[Round {round_id}] Client {i+1}/{num_clients} connected from {addr}")
+        
+        # Phase 1: collect public keys
+        public_keys = {}
+        for i in list(conns):
+            reply = exchange(i, {'type': SECAGG_SETUP, 'index': i, 'round': round_id}, "key advertisement")
+            if reply is not None:
+                public_keys[i] = reply['public_key']
+        aggregator.set_public_keys(public_keys)
+        
+        # Phase 2: collect encrypted secret shares and route them to their recipients
+        shares = {}
+        for i in list(conns):
+            reply = exchange(i, aggregator.keys_for(i), "secret sharing")
+            if reply is not None:
+                shares[i] = reply['shares']
+        inbox = aggregator.route_shares(shares)
+        print(f"[Round {round_id}] {len(inbox)} clients completed key setup")
+        
+        # Phase 3: broadcast the model to everyone first so clients train in parallel
+        for i in list(inbox):
+            try:
+                send_data(conns[i], {
+                    'type': SECAGG_TRAIN,
+                    'task': task,
+                    'model': global_state,
+                    'shares': inbox[i],
+                    'neighbors': aggregator.neighbors[i],
+                })
+            except Exception as e:
+                print(f"ERROR: Client {i+1} dropped before training: {e}")
+                conns.pop(i).close()
+        for i in list(conns):
+            try:
+                reply = pickle.loads(receive_data(conns[i]))
+                aggregator.add(i, reply['masked'])
+                if on_reply:
+                    on_reply(i, reply)
+                print(f"[Round {round_id}] Received masked update from client {i+1}")
+            except Exception as e:
+                print(f"ERROR: Client {i+1} dropped during training: {e}")
+                conns.pop(i).close()
+        
+        # Phase 4: remove self-masks and recover the masks of clients that dropped after sharing keys
+        dropped = aggregator.dropped()
+        if dropped:
+            print(f"[Round {round_id}] Recovering masks of dropped clients: {[d+1 for d in dropped]}")
+        revealed = {}
+        for i in list(conns):
+            reply = exchange(i, aggregator.unmask_request(i), "unmasking")
+            if reply is not None:
+                revealed[i] = reply['shares']
+        
+        num_contributors = len(aggregator.contributors)
+        if num_contributors < MIN_CLIENTS:
+            return None, num_contributors
+        _, layout = flatten_state_dict(global_state if template is None else template)
+        return aggregator.unmask(revealed, layout), num_contributors
+    finally:
+        for conn in conns.values():
+            conn.close()
 
 def main():
     server = None
+    shm_store = None
+    evaluator = None
+    event_server = None
     try:
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server.bind((HOST, PORT))
-        server.listen(NUM_CLIENTS)
+        server.listen(max(NUM_CLIENTS, LISTEN_BACKLOG) if EVENT_SERVER else NUM_CLIENTS)
         print(f"{'='*60}")
         print(f"Federated Learning Server - MNIST Classification")
         print(f"{'='*60}")
         print(f"Server listening on {HOST}:{PORT}")
         print(f"Waiting for up to {NUM_CLIENTS} clients per round")
         print(f"Minimum {MIN_CLIENTS} clients required to proceed with each round")
-        print(f"{'='*60}\n")
+        if EVENT_SERVER and (SECURE_AGG or SHM_TRANSPORT):
+            print(f"WARNING: EVENT_SERVER is ignored: {'SECURE_AGG' if SECURE_AGG else 'SHM_TRANSPORT'} takes "
+                  "precedence and uses its own exchange")
+        if SECURE_AGG:
+            print("Secure aggregation enabled: server only sees the sum of client updates")
+        elif SHM_TRANSPORT:
+            print("Shared memory transport enabled for same-host clients")
+        elif EVENT_SERVER:
+            event_server = EventServer(server)
+            print(f"Event-driven server: up to {event_server.max_connections} connections, "
+                  f"{event_server.max_uploads} concurrent uploads")
 
         global_model = MNISTNet()
+        if PERSONAL_LAYERS:
+            total = num_parameters(global_model.state_dict())
+            shared = num_parameters(shared_state(global_model))
+            print(f"Personalized mode: {', '.join(PERSONAL_LAYERS)} kept on clients, "
+                  f"exchanging {shared}/{total} parameters ({100. * shared / total:.1f}%)")
+            if FED_EVAL_EVERY and FED_EVAL_CLIENTS < MIN_CLIENTS:
+                print(f"WARNING: FED_EVAL_CLIENTS ({FED_EVAL_CLIENTS}) is below MIN_CLIENTS ({MIN_CLIENTS}); "
+                      "personal layers are never averaged, so global body accuracy and the checkpoint are skipped")
+            if not FED_EVAL_EVERY:
+                print("WARNING: Set FED_EVAL_EVERY (and HOLDOUT_FRACTION on clients) to report accuracy; "
+                      "rounds are not scored on the central test set in personalized mode")
+        print(f"{'='*60}\n")
         rounds = 5  # Increased rounds for better training
         
         # Training history for visualization
@@ -114,82 +488,100 @@ def main():
             'accuracies': [],
             'losses': [],
             'num_clients': [],
+            'federated_eval': [],
             'timestamp': datetime.now().isoformat()
         }
+        averaged_layers = None   # Personal layers from the latest federated evaluation (personalized mode)
+        append_history_log({'type': 'run'}, mode='w')  # Fresh live log; the header identifies this run
+        if ASYNC_EVAL and not PERSONAL_LAYERS:
+            if profiling.PROFILE:
+                # Keep evaluation on the profiled thread so each round's profile includes it
+                print("Profiling: evaluating each round synchronously")
+            else:
+                evaluator = BackgroundEvaluator(training_history)
 
         for r in range(rounds):
             print(f"\n{'='*60}")
             print(f"Round {r+1}/{rounds}")
             print(f"{'='*60}")
-            client_weights = []
+            profiling.start_round(f"server_round{r+1}")
+            global_state = shared_state(global_model)
+            
+            if SECURE_AGG:
+                try:
+                    new_state, num_clients_received = secure_aggregation_round(
+                        server, r+1, global_state)
+                except Exception as e:
+                    print(f"ERROR: Secure aggregation failed: {e}")
+                    import traceback
+                    traceback.print_exc()
+                    continue
+                if new_state is None:
+                    print(f"WARNING: Only {num_clients_received} clients participated, but {MIN_CLIENTS} required.")
+                    print(f"Skipping aggregation for round {r+1}. Global model unchanged.")
+                    continue
+            else:
+                if SHM_TRANSPORT:
+                    if shm_store is None:
+                        shm_store = SharedModelStore()
+                    shm_store.publish(global_state, r+1)
+                if event_server:
+                    client_weights = collect_client_updates_event(event_server, r+1, global_state)
+                else:
+                    client_weights = collect_client_updates(server, r+1, global_state, shm_store)
 
-            for i in range(NUM_CLIENTS):
-                conn = None
+                # Check minimum client threshold
+                num_clients_received = len(client_weights)
+                print(f"\n[Round {r+1}] Received updates from {num_clients_received}/{NUM_CLIENTS} clients")
+                
+                if num_clients_received < MIN_CLIENTS:
+                    print(f"WARNING: Only {num_clients_received} clients participated, but {MIN_CLIENTS} required.")
+                    print(f"Skipping aggregation for round {r+1}. Global model unchanged.")
+                    continue
+                
+                # Aggregate updates
                 try:
-                    print(f"[Round {r+1}] Waiting for client {i+1}/{NUM_CLIENTS}...")
-                    conn, addr = server.accept()
-                    conn.settimeout(120)  # 2 minute timeout per client
-                    print(f"[Round {r+1}] Client {i+1}/{NUM_CLIENTS} connected from {addr}")
-
-                    # Send global model
-                    print(f"[Round {r+1}] Sending global model to client {i+1}...")
-                    send_data(conn, global_model.state_dict())
-                    print(f"[Round {r+1}] Global model sent to client {i+1}")
-
-                    # Receive updated weights
-                    print(f"[Round {r+1}] Waiting for updates from client {i+1}...")
-                    recv_data = receive_data(conn)
-                    updated_weights = pickle.loads(recv_data)
-                    client_weights.append(updated_weights)
-                    print(f"[Round {r+1}] Received updates from client {i+1}")
-                    
-                except socket.timeout:
-                    print(f"ERROR: Client {i+1} timed out")
+                    new_state = aggregate_models(client_weights)
                 except Exception as e:
-                    print(f"ERROR: Failed to process client {i+1}: {e}")
-                finally:
-                    if conn:
-                        conn.close()
-
-            # Check minimum client threshold
-            num_clients_received = len(client_weights)
-            print(f"\n[Round {r+1}] Received updates from {num_clients_received}/{NUM_CLIENTS} clients")
+                    print(f"ERROR: Failed to aggregate models: {e}")
+                    import traceback
+                    traceback.print_exc()
+                    continue
             
-            if num_clients_received < MIN_CLIENTS:
-                print(f"WARNING: Only {num_clients_received} clients participated, but {MIN_CLIENTS} required.")
-                print(f"Skipping aggregation for round {r+1}. Global model unchanged.")
-                continue
+            global_model.load_state_dict(new_state, strict=not PERSONAL_LAYERS)
+            print(f"[Round {r+1}] ✓ Global model updated with {num_clients_received} client updates")
+            publish_checkpoint(global_model, averaged_layers)
             
-            # Aggregate updates
-            try:
-                new_state = aggregate_models(client_weights)
-                global_model.load_state_dict(new_state)
-                print(f"[Round {r+1}] ✓ Global model updated with {num_clients_received} client updates")
-                
-                # Evaluate model
-                accuracy, avg_loss = evaluate_model(global_model)
-                
-                # Save history
-                training_history['rounds'].append(r+1)
-                training_history['accuracies'].append(accuracy)
-                training_history['losses'].append(avg_loss)
-                training_history['num_clients'].append(num_clients_received)
-                
-                print(f"[Round {r+1}] ✓ Accuracy: {accuracy:.2f}%, Loss: {avg_loss:.4f}")
-                
-            except Exception as e:
-                print(f"ERROR: Failed to aggregate models: {e}")
-                import traceback
-                traceback.print_exc()
+            # Evaluate model (off the critical path when ASYNC_EVAL is on) and save history.
+            # In personalized mode the server's personal layers are never trained, so accuracy
+            # comes from the federated evaluation rounds only.
+            if evaluator:
+                evaluator.submit(r+1, global_model.state_dict(), num_clients_received)
+            elif not PERSONAL_LAYERS:
+                finish_evaluation(training_history, global_model, r+1, num_clients_received)
+            
+            if FED_EVAL_EVERY and (r+1) % FED_EVAL_EVERY == 0:
+                metrics, layers = federated_evaluation_round(server, r+1, global_model)
+                if metrics:
+                    record_federated_eval(training_history, r+1, metrics)
+                if layers is not None:
+                    averaged_layers = layers
+                    publish_checkpoint(global_model, averaged_layers)
 
+        if evaluator:
+            print("\nWaiting for background evaluation to finish...")
+            evaluator.close()
+            evaluator = None
+        profiling.end_round()
+        
         # Save final model and training history
         print("\n" + "="*60)
         print("Training complete!")
         print("="*60)
         
         # Save model
-        torch.save(global_model.state_dict(), "global_model.pth")
-        print("✓ Global model saved to 'global_model.pth'")
+        if publish_checkpoint(global_model, averaged_layers):
+            print("✓ Global model saved to 'global_model.pth'")
         
         # Save training history
         with open('training_history.json', 'w') as f:
@@ -212,6 +604,11 @@ def main():
         import traceback
         traceback.print_exc()
     finally:
+        if evaluator:
+            evaluator.close()
+        profiling.end_round()
+        if shm_store:
+            shm_store.close()
         if server:
             server.close()
             print("Server socket closed")
@@ -0,0 +1,132 @@
+"""
+Shared-memory model exchange for clients running on the same host as the server
+The global model is published once per round into a shared memory segment and each
+client writes its update into its own slot. Only small control messages go over the socket.
+"""
+import os
+import torch
+from multiprocessing import shared_memory, resource_tracker
+from model_def import flatten_state_dict, unflatten_state_dict
+
+SHM_OFFER = 'shm_offer'    # server -> client: segment names and parameter layout
+SHM_UPDATE = 'shm_update'  # client -> server: update has been written to the slot
+SHM_NACK = 'shm_nack'      # client -> server: cannot attach, send the model over the socket
+
+
+def is_local_peer(conn, addr):
+    """Check whether the peer of an accepted connection runs on this host"""
+    peer_ip = addr[0]
+    if peer_ip.startswith('127.') or peer_ip == '::1':
+        return True
+    # A peer connecting to one of our own addresses from that same address is local
+    return peer_ip == conn.getsockname()[0]
+
+
+def _as_tensor(segment, numel):
+    """View the first `numel` float32 values of a segment as a tensor (no copy)"""
+    return torch.frombuffer(segment.buf, dtype=torch.float32, count=numel)
+
+
+def attach_segment(name):
+    """
+    Attach to an existing segment without taking ownership of it
+
+    The server creates and unlinks every segment. Clients must not register the
+    segment with their resource tracker, otherwise it is unlinked when the client exits.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no `track` argument
+        segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+class SharedModelStore:
+    """Server side: owns the global model segment and one update slot per client"""
+
+    def __init__(self, prefix=None):
+        self.prefix = prefix or f"fl_{os.getpid()}"
+        self.global_segment = None
+        self.slots = {}
+        self.layout = None
+        self.numel = 0
+        self.version = 0
+
+    def _create(self, name, numel):
+        return shared_memory.SharedMemory(name=name, create=True, size=max(numel * 4, 1))
+
+    def publish(self, state_dict, version):
+        """Write the global model into the shared segment (once per round, version = round number)"""
+        flat, layout = flatten_state_dict(state_dict)
+        if self.global_segment is None or flat.numel() != self.numel:
+            self.close()
+            self.numel = flat.numel()
+            self.global_segment = self._create(f"{self.prefix}_global", self.numel)
+        view = _as_tensor(self.global_segment, self.numel)
+        view.copy_(flat)
+        del view
+        self.layout = layout
+        self.version = version
+
+    def offer(self, slot_id):
+        """Build the control message that points a client at the global model and its slot"""
+        if self.global_segment is None:
+            raise RuntimeError("No global model published")
+        if slot_id not in self.slots:
+            self.slots[slot_id] = self._create(f"{self.prefix}_slot{slot_id}", self.numel)
+        return {
+            'type': SHM_OFFER,
+            'global': self.global_segment.name,
+            'slot': self.slots[slot_id].name,
+            'layout': self.layout,
+            'numel': self.numel,
+            'version': self.version,
+        }
+
+    def read_slot(self, slot_id):
+        """Copy a client's update out of its slot"""
+        view = _as_tensor(self.slots[slot_id], self.numel)
+        state_dict = unflatten_state_dict(view, self.layout)
+        del view
+        return state_dict
+
+    def close(self):
+        """Release and unlink every segment owned by the server"""
+        for segment in [self.global_segment] + list(self.slots.values()):
+            if segment is None:
+                continue
+            try:
+                segment.close()
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+        self.global_segment = None
+        self.slots = {}
+
+
+def load_global_model(offer):
+    """Client side: read the global model published by the server"""
+    segment = attach_segment(offer['global'])
+    try:
+        view = _as_tensor(segment, offer['numel'])
+        state_dict = unflatten_state_dict(view, offer['layout'])
+        del view
+    finally:
+        segment.close()
+    return state_dict
+
+
+def write_update(offer, state_dict):
+    """Client side: write the updated model into this client's slot"""
+    flat, _ = flatten_state_dict(state_dict)
+    if flat.numel() != offer['numel']:
+        raise ValueError(f"Update has {flat.numel()} parameters, expected {offer['numel']}")
+    segment = attach_segment(offer['slot'])
+    try:
+        view = _as_tensor(segment, offer['numel'])
+        view.copy_(flat)
+        del view
+    finally:
+        segment.close()
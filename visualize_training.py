@@ -1,11 +1,110 @@
 """
 Visualization script for federated learning training results
-Plots accuracy and loss curves from training_history.json
+Plots accuracy and loss curves from training_history.json, or follows the
+server's append-only training_history.jsonl while training is running (--live)
 """
+import argparse
 import json
+import time
 import matplotlib.pyplot as plt
+import numpy as np
 import os
 
+MAX_PLOT_POINTS = 2000      # Longer histories are downsampled before drawing
+ANNOTATE_THRESHOLD = 30     # Per-point value labels only for short runs
+
+def downsample(xs, ys, max_points=MAX_PLOT_POINTS):
+    """
+    Reduce a series to at most max_points, keeping each bucket's min and max
+    so that spikes stay visible
+    """
+    xs, ys = np.asarray(xs), np.asarray(ys)
+    if len(xs) <= max_points:
+        return xs, ys
+    bucket = int(np.ceil(len(xs) / (max_points // 2)))
+    n_full = len(xs) // bucket * bucket
+    buckets = ys[:n_full].reshape(-1, bucket)
+    starts = np.arange(0, n_full, bucket)
+    idx = np.concatenate([starts + buckets.argmin(axis=1), starts + buckets.argmax(axis=1),
+                          np.arange(n_full, len(xs))])
+    idx = np.unique(idx)
+    return xs[idx], ys[idx]
+
+class HistoryTail:
+    """Incrementally reads new records from the append-only JSON-lines log"""
+    
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.offset = 0
+        self.partial = ""
+        self.inode = None
+        self.first_line = None
+    
+    def _is_new_run(self, stat):
+        """A new server run truncates or replaces the log and writes a new first line"""
+        if stat.st_size < self.offset or stat.st_ino != self.inode:
+            return True
+        if self.first_line is None:
+            return False
+        with open(self.log_file, 'r') as f:
+            first_line = f.readline()
+        return first_line.endswith("\n") and first_line != self.first_line
+    
+    def read_new(self):
+        """
+        Return records appended since the last call
+        
+        Returns:
+            tuple: (records, reset) where reset is True if the server started a new run
+        """
+        if not os.path.exists(self.log_file):
+            return [], False
+        reset = False
+        stat = os.stat(self.log_file)
+        if self.offset and self._is_new_run(stat):
+            self.offset, self.partial, reset = 0, "", True
+            self.first_line = None
+        with open(self.log_file, 'r') as f:
+            if self.offset == 0:
+                self.inode = stat.st_ino
+            if self.first_line is None:
+                line = f.readline()
+                if line.endswith("\n"):  # Still being written otherwise; retried next call
+                    self.first_line = line
+            f.seek(self.offset)
+            chunk = f.read()
+            self.offset = f.tell()
+        lines = (self.partial + chunk).split("\n")
+        self.partial = lines.pop()  # Incomplete last line, finished by a later write
+        records = []
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"WARNING: Skipping unreadable line in {self.log_file}")
+        return records, reset
+
+def round_records(records):
+    """Per-round metrics (logs written before record types existed have no 'type')"""
+    return [r for r in records if r.get('type', 'round') == 'round']
+
+def load_history(history_file):
+    """Load the final history JSON, or rebuild it from the JSON-lines log"""
+    if history_file.endswith('.jsonl'):
+        records, _ = HistoryTail(history_file).read_new()
+        rounds = round_records(records)
+        return {
+            'rounds': [r['round'] for r in rounds],
+            'accuracies': [r['accuracy'] for r in rounds],
+            'losses': [r['loss'] for r in rounds],
+            'num_clients': [r['num_clients'] for r in rounds],
+            'federated_eval': [r for r in records if r.get('type') == 'federated_eval'],
+        }
+    with open(history_file, 'r') as f:
+        return json.load(f)
+
 def plot_training_results(history_file='training_history.json'):
     """Plot accuracy and loss curves from training history"""
     
@@ -15,8 +114,7 @@ def plot_training_results(history_file='training_history.json'):
         return
     
     # Load training history
-    with open(history_file, 'r') as f:
-        history = json.load(f)
+    history = load_history(history_file)
     
     rounds = history['rounds']
     accuracies = history['accuracies']
@@ -30,8 +128,11 @@ def plot_training_results(history_file='training_history.json'):
     # Create figure with subplots
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 5))
     
+    annotate = len(rounds) <= ANNOTATE_THRESHOLD
+    marker_size = 8 if annotate else 0
+    
     # Plot accuracy
-    ax1.plot(rounds, accuracies, marker='o', linewidth=2, markersize=8, color='#2E86AB')
+    ax1.plot(*downsample(rounds, accuracies), marker='o', linewidth=2, markersize=marker_size, color='#2E86AB')
     ax1.set_xlabel('Training Round', fontsize=12, fontweight='bold')
     ax1.set_ylabel('Accuracy (%)', fontsize=12, fontweight='bold')
     ax1.set_title('Global Model Accuracy Over Training Rounds', fontsize=14, fontweight='bold')
@@ -39,7 +140,7 @@ def plot_training_results(history_file='training_history.json'):
     ax1.set_ylim([0, 100])
     
     # Add accuracy values on points
-    for i, (r, acc) in enumerate(zip(rounds, accuracies)):
+    for i, (r, acc) in enumerate(zip(rounds, accuracies) if annotate else []):
         ax1.annotate(f'{acc:.1f}%', 
                     xy=(r, acc), 
                     xytext=(0, 10),
@@ -49,14 +150,14 @@ def plot_training_results(history_file='training_history.json'):
                     bbox=dict(boxstyle='round,pad=0.3', facecolor='white', alpha=0.7))
     
     # Plot loss
-    ax2.plot(rounds, losses, marker='s', linewidth=2, markersize=8, color='#A23B72')
+    ax2.plot(*downsample(rounds, losses), marker='s', linewidth=2, markersize=marker_size, color='#A23B72')
     ax2.set_xlabel('Training Round', fontsize=12, fontweight='bold')
     ax2.set_ylabel('Loss', fontsize=12, fontweight='bold')
     ax2.set_title('Global Model Loss Over Training Rounds', fontsize=14, fontweight='bold')
     ax2.grid(True, alpha=0.3, linestyle='--')
     
     # Add loss values on points
-    for i, (r, loss) in enumerate(zip(rounds, losses)):
+    for i, (r, loss) in enumerate(zip(rounds, losses) if annotate else []):
         ax2.annotate(f'{loss:.3f}', 
                     xy=(r, loss), 
                     xytext=(0, 10),
@@ -90,10 +191,77 @@ def plot_training_results(history_file='training_history.json'):
     except:
         print("Note: Could not display plot window. Plot saved to file.")
 
+def live_plot(log_file='training_history.jsonl', interval=2.0, output_file='training_results.png'):
+    """Follow the server's JSON-lines log and update the curves as rounds finish"""
+    print(f"Watching '{log_file}' (Ctrl+C to stop)...")
+    tail = HistoryTail(log_file)
+    rounds, accuracies, losses = [], [], []
+    
+    interactive = plt.get_backend().lower() != 'agg'
+    if interactive:
+        plt.ion()
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 5))
+    acc_line, = ax1.plot([], [], linewidth=2, color='#2E86AB')
+    loss_line, = ax2.plot([], [], linewidth=2, color='#A23B72')
+    ax1.set_xlabel('Training Round', fontsize=12, fontweight='bold')
+    ax1.set_ylabel('Accuracy (%)', fontsize=12, fontweight='bold')
+    ax1.set_title('Global Model Accuracy (live)', fontsize=14, fontweight='bold')
+    ax1.grid(True, alpha=0.3, linestyle='--')
+    ax1.set_ylim([0, 100])
+    ax2.set_xlabel('Training Round', fontsize=12, fontweight='bold')
+    ax2.set_ylabel('Loss', fontsize=12, fontweight='bold')
+    ax2.set_title('Global Model Loss (live)', fontsize=14, fontweight='bold')
+    ax2.grid(True, alpha=0.3, linestyle='--')
+    plt.tight_layout()
+    
+    try:
+        while True:
+            records, reset = tail.read_new()
+            if reset:
+                print("New training run detected, clearing plots")
+                rounds, accuracies, losses = [], [], []
+            if records or reset:
+                for rec in round_records(records):
+                    rounds.append(rec['round'])
+                    accuracies.append(rec['accuracy'])
+                    losses.append(rec['loss'])
+                # Only the line data is replaced; axes and figure are reused
+                acc_line.set_data(*downsample(rounds, accuracies))
+                loss_line.set_data(*downsample(rounds, losses))
+                show_markers = len(rounds) <= ANNOTATE_THRESHOLD
+                acc_line.set_marker('o' if show_markers else '')
+                loss_line.set_marker('s' if show_markers else '')
+                for ax in (ax1, ax2):
+                    ax.relim()
+                    ax.autoscale_view(scalex=True, scaley=(ax is ax2))
+                if rounds:
+                    print(f"Round {rounds[-1]}: Accuracy {accuracies[-1]:.2f}%, Loss {losses[-1]:.4f}")
+                if interactive:
+                    fig.canvas.draw_idle()
+                else:
+                    fig.savefig(output_file, dpi=150, bbox_inches='tight')
+            if interactive:
+                plt.pause(interval)
+            else:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        fig.savefig(output_file, dpi=150, bbox_inches='tight')
+        print(f"\n✓ Plot saved to '{output_file}'")
+
 def main():
+    parser = argparse.ArgumentParser(description="Plot federated learning training curves")
+    parser.add_argument('--live', action='store_true', help="Follow the server's live log while training runs")
+    parser.add_argument('--history', default=None,
+                        help="History file (default: training_history.json, or training_history.jsonl with --live)")
+    parser.add_argument('--interval', type=float, default=2.0, help="Refresh interval in seconds for --live")
+    args = parser.parse_args()
+    
     print("Federated Learning Training Visualization")
     print("=" * 50)
-    plot_training_results()
+    if args.live:
+        live_plot(args.history or 'training_history.jsonl', args.interval)
+    else:
+        plot_training_results(args.history or 'training_history.json')
 
 if __name__ == "__main__":
     main()